@@ -0,0 +1,86 @@
+# Project/benchmarks/login_roundtrips.py
+#
+# Counts the database round trips of a login, with the old lookup sequence and with /user/login.
+# The setup of tests.support applies, the bcrypt cost is not what is measured.
+#
+#   python -m benchmarks.login_roundtrips
+
+import time
+import json
+from tests.support import PASSWORD, new_account
+from sqlalchemy import event
+from server import app, db
+from server.models import Account, Active_Sessions
+from server.session_store import token_digest
+
+ITERATIONS = 200
+
+
+class RoundTrips:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.statement)
+        event.listen(engine, 'commit', self.commit)
+
+    def statement(self, *args):
+        self.count += 1
+
+    def commit(self, *args):
+        self.count += 1
+
+
+def legacy_login(user_id, password):
+    """
+        The lookups the login did before fetching the account and the session together
+    """
+    user = Account.query.filter_by(user_id=user_id).first()
+    if user:
+        current_user = Account.find_by_id(user_id=user_id)
+        if Account.check_password_hash(current_user.password, password):
+            with_token = Active_Sessions.query.filter_by(user_id=user_id).first()
+            if with_token is None:
+                auth_token = Account.encode_auth_token(current_user.id)
+                refresh_token = Active_Sessions.generate_refresh_token()
+                active_session = Active_Sessions(token_hash=token_digest(auth_token),
+                                                 refresh_hash=token_digest(refresh_token), user_id=user_id)
+                active_session.save_to_db()
+    db.session.commit()
+    db.session.remove()
+
+
+def login(client, user_id, password):
+    data = json.dumps({'user_id': user_id, 'password': password})
+    client.post('/user/login', data=data, content_type='application/json')
+
+
+def run(name, function, trips, new_session, user_id):
+    total = 0
+    elapsed = 0.0
+    for _ in range(ITERATIONS):
+        if new_session:
+            Active_Sessions.query.filter_by(user_id=user_id).delete()
+            db.session.commit()
+            db.session.remove()
+
+        before = trips.count
+        start = time.perf_counter()
+        function()
+        elapsed += time.perf_counter() - start
+        total += trips.count - before
+
+    print('{:<8} {:<17} {:>6.2f} round trips {:>8.3f} ms'.format(
+        name, 'new session' if new_session else 'existing session',
+        total / ITERATIONS, elapsed * 1000 / ITERATIONS))
+
+
+if __name__ == '__main__':
+    user_id, password = new_account().user_id, PASSWORD
+    db.session.remove()
+
+    client = app.test_client()
+    login(client, user_id, password)  # the first request starts the maintenance jobs
+
+    trips = RoundTrips(db.engine)
+    for new_session in (True, False):
+        run('before', lambda: legacy_login(user_id, password), trips, new_session, user_id)
+        run('after', lambda: login(client, user_id, password), trips, new_session, user_id)
@@ -0,0 +1,85 @@
+# Project/benchmarks/startup.py
+#
+# Measures the import time of the application and the time from starting gunicorn to the
+# first successful request, with and without preloading the application in the master.
+# It needs the postgres of docker-compose running, migrated and seeded
+# (flask migrate && flask seed).
+#
+#   python -m benchmarks.startup
+
+import os
+import sys
+import time
+import json
+import socket
+import subprocess
+import requests
+
+RUNS = 3
+WORKERS = 4
+TIMEOUT = 60
+
+
+def import_time():
+    """
+        Seconds to import the application in a fresh interpreter
+    """
+    code = 'import time; start = time.perf_counter(); import server; print(time.perf_counter() - start)'
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return float(output.decode().strip().splitlines()[-1])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def first_success(url, process):
+    """
+        Polls the service until a login of a seeded carrier succeeds
+        :return: False when it did not succeed before TIMEOUT or the process exited
+    """
+    data = json.dumps({'user_id': 'transdev', 'password': 'transdev'})
+    headers = {'Content-Type': 'application/json'}
+    deadline = time.perf_counter() + TIMEOUT
+
+    while time.perf_counter() < deadline and process.poll() is None:
+        try:
+            response = requests.post(url + '/user/login', data=data, headers=headers, timeout=TIMEOUT)
+            if response.status_code == 200 and response.json()['message']['status'] == 'success':
+                return True
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.01)
+    return False
+
+
+def time_to_first_request(preload):
+    port = free_port()
+    env = dict(os.environ, GUNICORN_PRELOAD='1' if preload else '0', GUNICORN_BIND='127.0.0.1:{}'.format(port),
+               WEB_CONCURRENCY=str(WORKERS))
+
+    start = time.perf_counter()
+    process = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py', 'server.wsgi:app'], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        ok = first_success('http://127.0.0.1:{}'.format(port), process)
+        return time.perf_counter() - start if ok else None
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    imports = sorted(import_time() for _ in range(RUNS))
+    print('{:<24} {:>8.3f} s'.format('import', imports[len(imports) // 2]))
+
+    for preload in (False, True):
+        timings = [time_to_first_request(preload) for _ in range(RUNS)]
+        if None in timings:
+            print('{:<24} no successful request in {} s'.format('preload' if preload else 'no preload', TIMEOUT))
+            continue
+        timings.sort()
+        print('{:<24} {:>8.3f} s to the first successful request ({} workers)'.format(
+            'preload' if preload else 'no preload', timings[len(timings) // 2], WORKERS))
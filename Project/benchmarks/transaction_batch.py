@@ -0,0 +1,66 @@
+# Project/benchmarks/transaction_batch.py
+#
+# Adds the legs of a payment one by one with POST /payments/<id>/transactions, and all at once
+# with POST /payments/<id>/transactions/batch, and compares the time and the database round trips.
+# The setup of tests.support applies.
+#
+#   python -m benchmarks.transaction_batch
+
+import time
+import json
+from tests.support import PASSWORD, new_account
+from server import app, db
+from benchmarks.login_roundtrips import RoundTrips
+
+ITERATIONS = 50
+LEGS = (1, 5, 20)
+
+
+def post(client, path, headers, data):
+    return client.post(path, data=json.dumps(data), headers=headers, content_type='application/json').get_json()
+
+
+def new_payment(client, headers, seller):
+    data = {'request_id': 'bilhete', 'seller_id': seller, 'currency': 'EUR', 'reference': 'Porto - Lisboa'}
+    return post(client, '/payments/', headers, data)['message']['id']
+
+
+def one_by_one(client, headers, payment, legs):
+    for leg in legs:
+        post(client, '/payments/{}/transactions'.format(payment), headers, leg)
+
+
+def batch(client, headers, payment, legs):
+    post(client, '/payments/{}/transactions/batch'.format(payment), headers, legs)
+
+
+def run(name, function, client, headers, seller, trips, count):
+    legs = [{'amount': 10.5, 'reference': 'leg {}'.format(i)} for i in range(count)]
+    total = 0
+    elapsed = 0.0
+    for _ in range(ITERATIONS):
+        payment = new_payment(client, headers, seller)
+
+        before = trips.count
+        start = time.perf_counter()
+        function(client, headers, payment, legs)
+        elapsed += time.perf_counter() - start
+        total += trips.count - before
+
+    print('{:<12} {:>3} legs {:>7.2f} round trips {:>8.3f} ms'.format(
+        name, count, total / ITERATIONS, elapsed * 1000 / ITERATIONS))
+
+
+if __name__ == '__main__':
+    user_id = new_account().user_id
+    seller = str(new_account().id)
+    db.session.remove()
+
+    client = app.test_client()
+    login = post(client, '/user/login', {}, {'user_id': user_id, 'password': PASSWORD})
+    headers = {'Authorization': login['message']['auth_token']}
+
+    trips = RoundTrips(db.engine)
+    for count in LEGS:
+        run('one by one', one_by_one, client, headers, seller, trips, count)
+        run('batch', batch, client, headers, seller, trips, count)
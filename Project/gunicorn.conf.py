@@ -0,0 +1,29 @@
+# Project/gunicorn.conf.py
+#
+#   gunicorn -c gunicorn.conf.py server.wsgi:app
+#
+# With GUNICORN_PRELOAD (the default) the application is imported once in the master and
+# the workers are forked from it, so they skip the imports and the bcrypt calibration.
+
+import os
+
+bind = os.getenv('GUNICORN_BIND', ':5000')
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        # the mappers are configured once in the master instead of on the first query of each worker
+        from sqlalchemy.orm import configure_mappers
+        configure_mappers()
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        # a connection opened by the master must not be shared with the worker,
+        # the pool is emptied and each worker opens its own connections
+        from server import app, db
+        with app.app_context():
+            db.engine.dispose()
@@ -2,16 +2,19 @@
 
 # IMPORTS
 from flask import Flask, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
 from flask_cors import CORS
+from server.auxiliar_functions import Message
+from server.hashing import PasswordHasher, HashingBusy, calibrate_log_rounds
+from server.pool import InstrumentedQueuePool, PoolTimeout
+from server.routing import RoutingSQLAlchemy, recent_writes
+from http import HTTPStatus
 import os
 
 app = Flask(__name__, template_folder='templates', static_folder='static/static')
 CORS(app, support_credentials=True)
 
-db = SQLAlchemy()
-bcrypt = Bcrypt()
+db = RoutingSQLAlchemy()
+hasher = PasswordHasher()
 
 # database
 POSTGRES = {
@@ -27,15 +30,117 @@ DB_URL = 'postgresql+psycopg2://%(user)s:%(pw)s@%(host)s:%(port)s/%(db)s' % POST
 app.config['SQLALCHEMY_DATABASE_URI'] = DB_URL
 app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# connection pool of each worker. A request that waits DB_POOL_TIMEOUT seconds for a connection
+# is answered with 503 at once, and a statement running longer than DB_STATEMENT_TIMEOUT ms is cancelled
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.getenv('DB_MAX_OVERFLOW', 5))
+app.config['DB_POOL_TIMEOUT'] = float(os.getenv('DB_POOL_TIMEOUT', 1))
+app.config['DB_POOL_RECYCLE'] = int(os.getenv('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+app.config['DB_STATEMENT_TIMEOUT'] = int(os.getenv('DB_STATEMENT_TIMEOUT', 5000))
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': InstrumentedQueuePool,
+    'pool_size': app.config['DB_POOL_SIZE'],
+    'max_overflow': app.config['DB_MAX_OVERFLOW'],
+    'pool_timeout': app.config['DB_POOL_TIMEOUT'],
+    'pool_recycle': app.config['DB_POOL_RECYCLE'],
+    'pool_pre_ping': app.config['DB_POOL_PRE_PING'],
+    'connect_args': {'options': '-c statement_timeout={}'.format(app.config['DB_STATEMENT_TIMEOUT'])}
+}
+
+# a postgres replica serving the read-only endpoints. The reads of an account that wrote in the
+# last REPLICA_STICKY_SECONDS stay on the primary, so it never reads older data than it wrote
+app.config['SQLALCHEMY_REPLICA_URI'] = os.getenv('DATABASE_REPLICA_URL')
+app.config['REPLICA_STICKY_SECONDS'] = int(os.getenv('REPLICA_STICKY_SECONDS', 5))
+app.config['REPLICA_WRITES_PATH'] = os.getenv('REPLICA_WRITES_PATH')
+app.config['REPLICA_WRITES_SLOTS'] = int(os.getenv('REPLICA_WRITES_SLOTS', 65536))
+
+if app.config['SQLALCHEMY_REPLICA_URI']:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': app.config['SQLALCHEMY_REPLICA_URI']}
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'my_precious')
-app.config['BCRYPT_LOG_ROUNDS'] = 13
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.getenv('BCRYPT_LOG_ROUNDS', 13))
+# when set, the cost is calibrated at startup so a password check takes about this long. Each process calibrates
+# on its own, so passwords are only ever rehashed to a higher cost than the stored one
+app.config['BCRYPT_TARGET_MS'] = os.getenv('BCRYPT_TARGET_MS')
+
+if app.config['BCRYPT_TARGET_MS']:
+    app.config['BCRYPT_LOG_ROUNDS'] = calibrate_log_rounds(float(app.config['BCRYPT_TARGET_MS']))
+
+# bcrypt runs in a pool of processes, with a bounded queue of waiting hashes
+app.config['BCRYPT_POOL_SIZE'] = int(os.getenv('BCRYPT_POOL_SIZE', os.cpu_count() or 1))
+app.config['BCRYPT_QUEUE_DEPTH'] = int(os.getenv('BCRYPT_QUEUE_DEPTH', 16))
+app.config['BCRYPT_TIMEOUT'] = float(os.getenv('BCRYPT_TIMEOUT', 5))
+
+# short-lived access tokens (JWT), renewed with a long-lived opaque refresh token
+app.config['AUTH_TOKEN_LIFETIME'] = int(os.getenv('AUTH_TOKEN_LIFETIME', 900))
+app.config['REFRESH_TOKEN_LIFETIME'] = int(os.getenv('REFRESH_TOKEN_LIFETIME', 30 * 24 * 3600))
+
+# active sessions: 'shared_memory' (a table shared by the workers of the node, in front of the database) or 'database'
+app.config['SESSION_STORE'] = os.getenv('SESSION_STORE', 'shared_memory')
+app.config['SESSION_STORE_PATH'] = os.getenv('SESSION_STORE_PATH')
+app.config['SESSION_STORE_SLOTS'] = int(os.getenv('SESSION_STORE_SLOTS', 65536))
+
+# expired sessions are deleted every SESSION_SWEEP_INTERVAL seconds (0 disables it), in batches
+app.config['SESSION_SWEEP_INTERVAL'] = int(os.getenv('SESSION_SWEEP_INTERVAL', 600))
+app.config['SESSION_SWEEP_BATCH'] = int(os.getenv('SESSION_SWEEP_BATCH', 1000))
+
+# the balances are snapshotted from the ledger every BALANCE_SNAPSHOT_INTERVAL seconds (0 disables it)
+app.config['BALANCE_SNAPSHOT_INTERVAL'] = int(os.getenv('BALANCE_SNAPSHOT_INTERVAL', 300))
+
+# transaction is partitioned by month: the partitions of the next TRANSACTION_PARTITIONS_AHEAD months are
+# created every TRANSACTION_PARTITIONS_INTERVAL seconds, and the ones older than TRANSACTION_RETENTION_MONTHS
+# are detached from it (0 keeps them all)
+app.config['TRANSACTION_PARTITIONS_INTERVAL'] = int(os.getenv('TRANSACTION_PARTITIONS_INTERVAL', 24 * 3600))
+app.config['TRANSACTION_PARTITIONS_AHEAD'] = int(os.getenv('TRANSACTION_PARTITIONS_AHEAD', 3))
+app.config['TRANSACTION_RETENTION_MONTHS'] = int(os.getenv('TRANSACTION_RETENTION_MONTHS', 0))
+
+# completed and cancelled payments older than PAYMENT_ARCHIVE_AGE_DAYS are moved to payment_archive every
+# PAYMENT_ARCHIVE_INTERVAL seconds (0 disables it), PAYMENT_ARCHIVE_BATCH payments per transaction
+app.config['PAYMENT_ARCHIVE_INTERVAL'] = int(os.getenv('PAYMENT_ARCHIVE_INTERVAL', 3600))
+app.config['PAYMENT_ARCHIVE_AGE_DAYS'] = int(os.getenv('PAYMENT_ARCHIVE_AGE_DAYS', 90))
+app.config['PAYMENT_ARCHIVE_BATCH'] = int(os.getenv('PAYMENT_ARCHIVE_BATCH', 500))
+
+# "flask settle" executes the authorized payments in chunks of SETTLEMENT_CHUNK payments per database
+# transaction, in SETTLEMENT_PROCESSES processes; the ones still running after SETTLEMENT_TIMEOUT seconds are killed
+app.config['SETTLEMENT_CHUNK'] = int(os.getenv('SETTLEMENT_CHUNK', 500))
+app.config['SETTLEMENT_PROCESSES'] = int(os.getenv('SETTLEMENT_PROCESSES', 4))
+app.config['SETTLEMENT_TIMEOUT'] = int(os.getenv('SETTLEMENT_TIMEOUT', 3600))
+
+# the responses of the requests sent with an Idempotency-Key are replayed for IDEMPOTENCY_TTL seconds. Each
+# worker caches IDEMPOTENCY_CACHE_SIZE of them; a request that did not finish in IDEMPOTENCY_CLAIM_TIMEOUT
+# seconds gives up its key. The expired keys are deleted every IDEMPOTENCY_SWEEP_INTERVAL seconds (0 disables it)
+app.config['IDEMPOTENCY_TTL'] = int(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))
+app.config['IDEMPOTENCY_CACHE_SIZE'] = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', 10000))
+app.config['IDEMPOTENCY_CLAIM_TIMEOUT'] = int(os.getenv('IDEMPOTENCY_CLAIM_TIMEOUT', 30))
+app.config['IDEMPOTENCY_SWEEP_INTERVAL'] = int(os.getenv('IDEMPOTENCY_SWEEP_INTERVAL', 3600))
+app.config['IDEMPOTENCY_SWEEP_BATCH'] = int(os.getenv('IDEMPOTENCY_SWEEP_BATCH', 1000))
+
+# GET /payments/ and GET /payments/<id>/transactions return pages of PAGE_SIZE_DEFAULT rows, ?limit= up to PAGE_SIZE_MAX
+app.config['PAGE_SIZE_DEFAULT'] = int(os.getenv('PAGE_SIZE_DEFAULT', 50))
+app.config['PAGE_SIZE_MAX'] = int(os.getenv('PAGE_SIZE_MAX', 200))
+
+# most transactions accepted by one POST /payments/<id>/transactions/batch
+app.config['TRANSACTION_BATCH_LIMIT'] = int(os.getenv('TRANSACTION_BATCH_LIMIT', 100))
+
+# verified tokens cached by each worker, so authenticated calls skip the active session query
+app.config['TOKEN_CACHE_SIZE'] = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+app.config['TOKEN_CACHE_TTL'] = int(os.getenv('TOKEN_CACHE_TTL', 60))
 
 from server.user_controller import user_controller
 from server.account_controller import account_controller
 from server.payment_controller import payment_controller
+from server.models import token_cache, session_store
+from server.maintenance import jobs_stats
+from server.idempotency import idempotency_cache
+# the schema is created and upgraded by "flask migrate", never when a worker boots
+import server.migrations
+import server.settlement
 
-bcrypt.init_app(app)
+hasher.init_app(app)
 db.init_app(app)
+recent_writes.init_app(app)
 
 # register routes from user_controller
 app.register_blueprint(user_controller)
@@ -46,11 +151,6 @@ app.register_blueprint(account_controller)
 # register routes from payment_controller
 app.register_blueprint(payment_controller)
 
-with app.app_context():
-    db.drop_all()
-    db.engine.execute('CREATE EXTENSION IF NOT EXISTS "uuid-ossp";')
-    db.create_all()
-
 app.app_context().push()
 # Home
 @app.route('/', methods=['GET'])
@@ -61,3 +161,36 @@ def home():
     return jsonify(response), 200
 
 
+# Worker statistics
+@app.route('/stats', methods=['GET'])
+def stats():
+    response = {
+        'status': 'success',
+        'pid': os.getpid(),
+        'token_cache': token_cache.stats(),
+        'session_store': session_store.stats(),
+        'hasher': hasher.stats(),
+        'idempotency_cache': idempotency_cache.stats(),
+        'pool': db.engine.pool.stats(),
+        'jobs': jobs_stats()
+    }
+    return jsonify(response), 200
+
+
+@app.errorhandler(HashingBusy)
+def hashing_busy(error):
+    response = {
+        'status': 'fail',
+        'message': 'The service is busy. Try again later.'
+    }
+    return Message.message(HTTPStatus.SERVICE_UNAVAILABLE, response), HTTPStatus.SERVICE_UNAVAILABLE, {'Retry-After': '1'}
+
+
+@app.errorhandler(PoolTimeout)
+def pool_exhausted(error):
+    response = {
+        'status': 'fail',
+        'message': 'The service is busy. Try again later.'
+    }
+    db.session.remove()
+    return Message.message(HTTPStatus.SERVICE_UNAVAILABLE, response), HTTPStatus.SERVICE_UNAVAILABLE, {'Retry-After': '1'}
@@ -1,8 +1,12 @@
 from flask import request, Blueprint, render_template
 from server import db
 from server.auxiliar_functions import Auxiliar, Message
+from server.hashing import HashingBusy
+from server.pool import PoolTimeout
 from server.user_controller import login_required
+from server.routing import read_only
 from server.models import Account
+from server.money import to_minor_units, to_major_units
 from http import HTTPStatus
 from iso4217 import Currency
 from flask_cors import cross_origin
@@ -23,6 +27,7 @@ def test_connection():
 
 
 @account_controller.route('/account/trans', methods=['GET'])
+@read_only
 def get_trans():
     msg = Message()
     transdev_account = Account.find_by_id("transdev")
@@ -81,12 +86,15 @@ def create_account():
                         'user': ac.user_id,
                         'password': ac.password,
                         'currency': ac.currency.name,
-                        'balance': ac.balance,
+                        'balance': to_major_units(ac.available_balance(), ac.currency),
                         'state': 'active' if ac.state else 'desactive',
                         'created_at': ac.created_at,
                         'updated_at': ac.updated_at
                     }
                 }
+        except (HashingBusy, PoolTimeout):
+            # answered with 503 by the application error handlers
+            raise
         except Exception as exc:
             code = HTTPStatus.INTERNAL_SERVER_ERROR
             response = {
@@ -106,7 +114,7 @@ def create_account():
 
 @account_controller.route('/account/amount', methods=['POST'])
 @login_required
-def add_amount(account_id):
+def add_amount(account):
     """
         Add an amount to an account
 
@@ -116,50 +124,42 @@ def add_amount(account_id):
     code = HTTPStatus.OK
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
-
-    if account:
+    if account.state:
+        try:
+            # Get parameters
+            amount = request.json.get('amount')
 
-        if account.state:
+            # Validate the parameters, the amount is kept in minor units of the account currency
             try:
-                # Get parameters
-                amount = request.json.get('amount')
-
-                # Validate the parameters
-                if not isinstance(float(amount), float):
-                    code = HTTPStatus.BAD_REQUEST
-                    raise Exception("Your amount is wrong. The amount is not valid")
-
-                elif float(amount) < 0.0:
-                    code = HTTPStatus.BAD_REQUEST
-                    raise Exception("Your amount is wrong. The amount needs to be more than 0.0")
-            except Exception as excep:
-                response = {
-                    'status': 'fail',
-                    'message': str(excep)
-                }
-
-            # Update the total amount in his account
-            account.balance += amount
-            db.session.commit()
-
-            response = {
-                'status': 'success',
-                'message': 'The amount was added.'
-            }
+                amount = to_minor_units(amount, account.currency)
+            except ValueError as excep:
+                code = HTTPStatus.BAD_REQUEST
+                raise Exception("Your amount is wrong. " + str(excep))
 
-        else:
-            code = HTTPStatus.METHOD_NOT_ALLOWED
+            if amount < 0:
+                code = HTTPStatus.BAD_REQUEST
+                raise Exception("Your amount is wrong. The amount needs to be more than 0.0")
+        except Exception as excep:
+            code = HTTPStatus.BAD_REQUEST
             response = {
                 'status': 'fail',
-                'message': 'Your number account is desactivated.'
+                'message': str(excep)
             }
-        return msg.message(code, response)
+            return msg.message(code, response)
+
+        # Append the deposit to the ledger, the balance of the account is computed from it
+        Account.deposit(account.id, amount)
+        db.session.commit()
+
+        response = {
+            'status': 'success',
+            'message': 'The amount was added.'
+        }
     else:
-        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        code = HTTPStatus.METHOD_NOT_ALLOWED
         response = {
             'status': 'fail',
-            'message': 'Try Again.'
+            'message': 'Your number account is desactivated.'
         }
 
     return msg.message(code, response)
@@ -167,7 +167,7 @@ def add_amount(account_id):
 
 @account_controller.route('/account/activate', methods=['POST'])
 @login_required
-def activate_account(account_id):
+def activate_account(account):
     """
         Activate the user account
 
@@ -177,35 +177,25 @@ def activate_account(account_id):
     code = HTTPStatus.OK
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
-
-    if account:
+    if not account.state:
+        # Update the state of the account
+        account.state = True
+        db.session.commit()
 
-        if not account.state:
-            # Update the state of the account
-            account.state = True
-            db.session.commit()
-
-            response = {
-                'status': 'success',
-                'message': 'Successfully activated.',
-            }
-        else:
-            code = HTTPStatus.NOT_MODIFIED
-            response = "The account is already activated"
-    else:
-        code = HTTPStatus.INTERNAL_SERVER_ERROR
         response = {
-            'status': 'fail',
-            'message': 'Try Again.'
+            'status': 'success',
+            'message': 'Successfully activated.',
         }
+    else:
+        code = HTTPStatus.NOT_MODIFIED
+        response = "The account is already activated"
 
     return msg.message(code, response)
 
 
 @account_controller.route('/account/desactivate', methods=['POST'])
 @login_required
-def desativate_account(account_id):
+def desativate_account(account):
     """
         Desactivate the user account
 
@@ -215,28 +205,19 @@ def desativate_account(account_id):
     code = HTTPStatus.OK
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
-
-    if account:
-        if account.state:
-            account.state = False
-            db.session.commit()
+    if account.state:
+        account.state = False
+        db.session.commit()
 
-            response = {
-                'status': 'success',
-                'message': 'Successfully desactivated.',
-            }
-        else:
-            code = HTTPStatus.NOT_MODIFIED
-            response = {
-                'status': 'fail',
-                'message': 'The account is already desactivated'
-            }
+        response = {
+            'status': 'success',
+            'message': 'Successfully desactivated.',
+        }
     else:
-        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        code = HTTPStatus.NOT_MODIFIED
         response = {
             'status': 'fail',
-            'message': 'Try Again.'
+            'message': 'The account is already desactivated'
         }
 
     return msg.message(code, response)
@@ -244,7 +225,8 @@ def desativate_account(account_id):
 # Get account information
 @account_controller.route('/account/', methods=['GET'])
 @login_required
-def account_info(account_id):
+@read_only
+def account_info(account):
     """
         Get the account information
 
@@ -254,28 +236,19 @@ def account_info(account_id):
     code = HTTPStatus.OK
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
-
-    if account:
-        response = {
-            'status': 'success',
-            'account':
-            {
-                'id': account.id,
-                'user': account.user_id,
-                'balance': account.balance,
-                'currency': account.currency.name,
-                'state': 'active' if account.state else 'desactive',
-                'created_at': account.created_at,
-                'updated_at': account.updated_at
-            }
+    response = {
+        'status': 'success',
+        'account':
+        {
+            'id': account.id,
+            'user': account.user_id,
+            'balance': to_major_units(account.available_balance(), account.currency),
+            'currency': account.currency.name,
+            'state': 'active' if account.state else 'desactive',
+            'created_at': account.created_at,
+            'updated_at': account.updated_at
         }
-    else:
-        code = HTTPStatus.INTERNAL_SERVER_ERROR
-        response = {
-            'status': 'fail',
-            'message': 'Try Again.'
-        } 
+    }
 
     return msg.message(code, response)
 
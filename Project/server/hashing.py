@@ -0,0 +1,128 @@
+# server/hashing.py
+
+import os
+import time
+import threading
+import bcrypt
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+
+class HashingBusy(Exception):
+    """
+        Raised when the password hashing pool can not take more work
+    """
+    pass
+
+
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode()
+
+
+def _check_password(pw_hash, password):
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+def hash_rounds(pw_hash):
+    """
+        Returns the cost a bcrypt hash was created with ($2b$<cost>$<salt and hash>)
+    """
+    return int(pw_hash.split('$')[2])
+
+
+def calibrate_log_rounds(target_ms, minimum=4, maximum=16, samples=3):
+    """
+        Picks the highest bcrypt cost whose verification stays under target_ms on this machine.
+        Each extra round doubles the work, so one cheap measurement is enough to extrapolate.
+    """
+    base = 8
+    pw_hash = _hash_password('calibration', base)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        _check_password(pw_hash, 'calibration')
+        timings.append((time.perf_counter() - start) * 1000)
+    elapsed = sorted(timings)[len(timings) // 2]
+
+    rounds = minimum
+    while rounds < maximum and elapsed * 2 ** (rounds + 1 - base) <= target_ms:
+        rounds += 1
+    return rounds
+
+
+class PasswordHasher:
+    """
+        Runs bcrypt in a bounded process pool, so a burst of logins does not block the
+        threads that serve the other endpoints. When more than BCRYPT_QUEUE_DEPTH hashes
+        are waiting, new ones are rejected at once with HashingBusy.
+        With BCRYPT_POOL_SIZE = 0 the hashes are computed inline.
+    """
+
+    def __init__(self, app=None):
+        self.pool_size = 0
+        self.queue_depth = 0
+        self.timeout = None
+        self.rejected = 0
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.pool_size = app.config.get('BCRYPT_POOL_SIZE', 0)
+        self.queue_depth = app.config.get('BCRYPT_QUEUE_DEPTH', 0) or 2 * self.pool_size
+        self.timeout = app.config.get('BCRYPT_TIMEOUT')
+
+    def generate_password_hash(self, password, rounds=None):
+        if rounds is None:
+            rounds = self.app.config['BCRYPT_LOG_ROUNDS']
+        return self._run(_hash_password, password, rounds)
+
+    def check_password_hash(self, pw_hash, password):
+        return self._run(_check_password, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        # only upward: processes calibrated to different costs must not rehash a password back and forth
+        return hash_rounds(pw_hash) < self.app.config['BCRYPT_LOG_ROUNDS']
+
+    def stats(self):
+        return {
+            'log_rounds': self.app.config['BCRYPT_LOG_ROUNDS'],
+            'pool_size': self.pool_size,
+            'queue_depth': self.queue_depth,
+            'rejected': self.rejected
+        }
+
+    def _run(self, function, *args):
+        if not self.pool_size:
+            return function(*args)
+
+        executor, slots = self._get_executor()
+
+        if not slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HashingBusy('The password hashing queue is full')
+
+        try:
+            future = executor.submit(function, *args)
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda f: slots.release())
+
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HashingBusy('The password hashing took too long')
+
+    def _get_executor(self):
+        # the pool can not be shared with a forked gunicorn worker, each process has its own
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.pool_size)
+                self._slots = threading.BoundedSemaphore(self.pool_size + self.queue_depth)
+                self._pid = os.getpid()
+            return self._executor, self._slots
@@ -0,0 +1,125 @@
+# server/idempotency.py
+
+import hashlib
+import datetime
+from functools import wraps
+from flask import request, g, current_app
+from http import HTTPStatus
+from server import app
+from server.auxiliar_functions import Message
+from server.cache import LRUCache
+from server.models import Idempotency_Keys
+
+
+# Finished responses of this worker by (account id, key), they never change once stored
+idempotency_cache = LRUCache(app.config['IDEMPOTENCY_CACHE_SIZE'], app.config['IDEMPOTENCY_TTL'])
+
+
+def request_fingerprint():
+    """
+        sha256 of the method, the path and the body, to tell a retry from another request reusing the key
+    """
+    digest = hashlib.sha256()
+    digest.update('{} {}\n'.format(request.method, request.path).encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def stored_response(account_id, key):
+    """
+        (fingerprint, status, body) of the finished request with the key, from the cache or else from the table
+    """
+    cache_key = (str(account_id), key)
+    stored = idempotency_cache.get(cache_key)
+    if stored is not None:
+        return stored
+
+    row = Idempotency_Keys.find(account_id, key)
+    if row is None or row.status is None:
+        return None
+
+    stored = (row.fingerprint, row.status, row.response)
+    idempotency_cache.set(cache_key, stored, ttl=(row.expires_at - datetime.datetime.utcnow()).total_seconds())
+    return stored
+
+
+def replay(stored, fingerprint):
+    msg = Message()
+    stored_fingerprint, status, body = stored
+
+    if stored_fingerprint != fingerprint:
+        response = {
+            'status': 'fail',
+            'message': 'The Idempotency-Key was already used for another request.'
+        }
+        return msg.message(HTTPStatus.UNPROCESSABLE_ENTITY, response)
+
+    response = current_app.response_class(body, status=status, mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def failed(response):
+    """
+        True when the response reports an error of the service, which the client is expected to retry
+    """
+    body = response.get_json(silent=True)
+    code = body.get('code') if isinstance(body, dict) else None
+    return response.status_code >= 500 or (isinstance(code, int) and code >= 500)
+
+
+def idempotent(f):
+    """
+        Sends again the stored response when a request comes with an Idempotency-Key header already
+        used by the account, instead of running it twice. Goes after login_required.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kws):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(*args, **kws)
+
+        msg = Message()
+        if not key or len(key) > 255:
+            response = {
+                'status': 'fail',
+                'message': 'The Idempotency-Key must have between 1 and 255 characters.'
+            }
+            return msg.message(HTTPStatus.BAD_REQUEST, response)
+
+        account_id = g.account_id
+        fingerprint = request_fingerprint()
+
+        # A retry of a finished request reads, and writes nothing
+        stored = stored_response(account_id, key)
+        if stored is not None:
+            return replay(stored, fingerprint)
+
+        if not Idempotency_Keys.claim(account_id, key, fingerprint, app.config['IDEMPOTENCY_TTL'],
+                                      app.config['IDEMPOTENCY_CLAIM_TIMEOUT']):
+            # it finished meanwhile, or it is still running
+            stored = stored_response(account_id, key)
+            if stored is not None:
+                return replay(stored, fingerprint)
+
+            response = {
+                'status': 'fail',
+                'message': 'A request with this Idempotency-Key is still running. Try again later.'
+            }
+            return msg.message(HTTPStatus.CONFLICT, response), {'Retry-After': '1'}
+
+        try:
+            response = current_app.make_response(f(*args, **kws))
+        except Exception:
+            Idempotency_Keys.release(account_id, key)
+            raise
+
+        if failed(response):
+            Idempotency_Keys.release(account_id, key)
+        else:
+            body = response.get_data(as_text=True)
+            Idempotency_Keys.complete(account_id, key, response.status_code, body)
+            idempotency_cache.set((str(account_id), key), (fingerprint, response.status_code, body))
+        return response
+
+    return decorated_function
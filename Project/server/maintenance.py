@@ -0,0 +1,295 @@
+# server/maintenance.py
+
+import time
+import zlib
+import datetime
+import threading
+import click
+from server import app, db
+from server.pool import lift_statement_timeout
+from server.models import Active_Sessions, Idempotency_Keys, Payment, Payment_Archive, PaymentState, Transaction
+
+
+class PeriodicJob(threading.Thread):
+    """
+        Runs a maintenance function every interval seconds in a daemon thread of the worker.
+        A postgres advisory lock makes sure a single process of the cluster runs it at a time,
+        the others skip that run.
+    """
+
+    def __init__(self, name, function, interval):
+        super().__init__(name=name, daemon=True)
+        self.function = function
+        self.interval = interval
+        self.lock_key = zlib.crc32(name.encode())
+        self.runs = 0
+        self.last_run = None
+        self.last_result = None
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with app.app_context():
+                    self.run_once()
+            except Exception:
+                app.logger.exception('Maintenance job %s failed', self.name)
+
+    def run_once(self):
+        with db.engine.connect() as connection:
+            if not connection.execute('SELECT pg_try_advisory_lock(%s)', self.lock_key).scalar():
+                return
+            try:
+                self.last_result = self.function()
+                self.last_run = datetime.datetime.utcnow().isoformat()
+                self.runs += 1
+            finally:
+                db.session.remove()
+                connection.execute('SELECT pg_advisory_unlock(%s)', self.lock_key)
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'last_run': self.last_run,
+            'last_result': self.last_result
+        }
+
+
+jobs = []
+
+
+def schedule(name, function, interval):
+    if interval > 0:
+        jobs.append(PeriodicJob(name, function, interval))
+
+
+def start_jobs():
+    """
+        Starts the scheduled jobs in this process. Threads do not survive a fork,
+        so they are started by each worker, never by the gunicorn master.
+    """
+    for job in jobs:
+        if job.ident is None:
+            job.start()
+
+
+def jobs_stats():
+    return {job.name: job.stats() for job in jobs}
+
+
+def sweep_expired_sessions(batch_size=None):
+    """
+        Deletes the sessions whose refresh token already expired, batch_size rows per transaction
+        :return: the number of sessions reclaimed
+    """
+    batch_size = batch_size or app.config['SESSION_SWEEP_BATCH']
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=app.config['REFRESH_TOKEN_LIFETIME'])
+    reclaimed = 0
+
+    while True:
+        lift_statement_timeout(db.session)
+        expired = db.session.query(Active_Sessions.id) \
+            .filter(Active_Sessions.emission_at < cutoff) \
+            .limit(batch_size) \
+            .subquery()
+        deleted = Active_Sessions.query \
+            .filter(Active_Sessions.id.in_(expired)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+        reclaimed += deleted
+        if deleted < batch_size:
+            break
+
+    app.logger.info('Reclaimed %d expired sessions', reclaimed)
+    return reclaimed
+
+
+def sweep_idempotency_keys(batch_size=None):
+    """
+        Deletes the Idempotency-Keys past their expiry, batch_size rows per transaction
+        :return: the number of keys deleted
+    """
+    batch_size = batch_size or app.config['IDEMPOTENCY_SWEEP_BATCH']
+    now = datetime.datetime.utcnow()
+    deleted = 0
+
+    while True:
+        lift_statement_timeout(db.session)
+        expired = db.session.query(Idempotency_Keys.account_id, Idempotency_Keys.key) \
+            .filter(Idempotency_Keys.expires_at <= now) \
+            .limit(batch_size) \
+            .subquery()
+        count = Idempotency_Keys.query \
+            .filter(db.tuple_(Idempotency_Keys.account_id, Idempotency_Keys.key).in_(expired)) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+
+        deleted += count
+        if count < batch_size:
+            break
+
+    app.logger.info('Deleted %d expired idempotency keys', deleted)
+    return deleted
+
+
+def take_balance_snapshots():
+    """
+        Folds the ledger entries appended since the last run into the balance snapshots.
+        The ledger is locked against inserts for the duration of the statement, so no entry
+        committed later can get an id lower than the ones already folded.
+        :return: the number of accounts whose snapshot changed
+    """
+    lift_statement_timeout(db.session)
+    db.session.execute('LOCK TABLE ledger_entries IN SHARE MODE')
+    result = db.session.execute(db.text("""
+        INSERT INTO balance_snapshots (account_id, entry_id, balance, taken_at)
+        SELECT e.account_id, max(e.id), coalesce(s.balance, 0) + sum(e.amount), now()
+        FROM ledger_entries e
+        LEFT JOIN balance_snapshots s ON s.account_id = e.account_id
+        WHERE e.id > (SELECT coalesce(max(entry_id), 0) FROM balance_snapshots)
+          AND e.account_id IS NOT NULL
+        GROUP BY e.account_id, s.balance
+        ON CONFLICT (account_id) DO UPDATE
+        SET entry_id = excluded.entry_id, balance = excluded.balance, taken_at = excluded.taken_at
+    """))
+    db.session.commit()
+
+    app.logger.info('Snapshotted the balance of %d accounts', result.rowcount)
+    return result.rowcount
+
+
+def manage_transaction_partitions():
+    """
+        Creates the monthly partitions of transaction for the next TRANSACTION_PARTITIONS_AHEAD months
+        and detaches the ones older than TRANSACTION_RETENTION_MONTHS. Detaching only changes the
+        catalog, the rows stay in a plain table named after the month. That table loses its foreign
+        key to payment, so archive_payments can still delete the payments whose transactions it holds.
+        :return: the partitions created and detached
+    """
+    lift_statement_timeout(db.session)
+    created = [name for name, in db.session.execute(db.text("""
+        SELECT create_transaction_partition(date_trunc('month', now()) + n * interval '1 month')
+        FROM generate_series(0, :ahead) n
+    """), {'ahead': app.config['TRANSACTION_PARTITIONS_AHEAD']}) if name]
+
+    detached = []
+    retention = app.config['TRANSACTION_RETENTION_MONTHS']
+    if retention > 0:
+        today = datetime.date.today()
+        months = today.year * 12 + today.month - 1 - retention
+        oldest = 'transaction_{:04d}_{:02d}'.format(months // 12, months % 12 + 1)
+
+        partitions = db.session.execute(db.text("""
+            SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'transaction'::regclass AND c.relname < :oldest AND c.relname <> 'transaction_default'
+            ORDER BY c.relname
+        """), {'oldest': oldest})
+        for name, in partitions.fetchall():
+            quoted = db.engine.dialect.identifier_preparer.quote(name)
+            db.session.execute('ALTER TABLE transaction DETACH PARTITION {}'.format(quoted))
+
+            foreign_keys = db.session.execute(db.text("""
+                SELECT conname FROM pg_constraint WHERE conrelid = CAST(:name AS regclass) AND contype = 'f'
+            """), {'name': quoted})
+            for constraint, in foreign_keys.fetchall():
+                db.session.execute('ALTER TABLE {} DROP CONSTRAINT {}'.format(
+                    quoted, db.engine.dialect.identifier_preparer.quote(constraint)))
+            detached.append(name)
+
+    # rows only land there when no monthly partition covers their emission date
+    stray = db.session.execute('SELECT EXISTS (SELECT 1 FROM transaction_default)').scalar()
+    db.session.commit()
+
+    if stray:
+        app.logger.warning('transaction_default has rows: transactions were emitted out of the monthly partitions')
+    app.logger.info('Created the partitions %s, detached %s', created, detached)
+    return {'created': created, 'detached': detached, 'default_has_rows': stray}
+
+
+def archive_payments(batch_size=None):
+    """
+        Moves the completed and cancelled payments older than PAYMENT_ARCHIVE_AGE_DAYS, with their
+        transactions, to payment_archive. Each batch of batch_size payments is one transaction, and
+        payments locked by a request are skipped until the next run.
+        :return: the number of payments archived
+    """
+    batch_size = batch_size or app.config['PAYMENT_ARCHIVE_BATCH']
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=app.config['PAYMENT_ARCHIVE_AGE_DAYS'])
+    archived = 0
+
+    while True:
+        lift_statement_timeout(db.session)
+        payments = Payment.query \
+            .filter(Payment.state.in_([PaymentState.completed, PaymentState.cancelled]), Payment.created_at < cutoff) \
+            .order_by(Payment.created_at) \
+            .limit(batch_size) \
+            .with_for_update(skip_locked=True) \
+            .all()
+        if not payments:
+            break
+
+        ids = [payment.id for payment in payments]
+        transactions = {}
+        for transaction in Transaction.query.filter(Transaction.id_payment.in_(ids)):
+            transactions.setdefault(transaction.id_payment, []).append(transaction)
+
+        db.session.execute(Payment_Archive.__table__.insert().values(
+            [Payment_Archive.pack(payment, transactions.get(payment.id, [])) for payment in payments]))
+        Transaction.query.filter(Transaction.id_payment.in_(ids)).delete(synchronize_session=False)
+        Payment.query.filter(Payment.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        archived += len(payments)
+        if len(payments) < batch_size:
+            break
+
+    app.logger.info('Archived %d payments', archived)
+    return archived
+
+
+schedule('sweep-sessions', sweep_expired_sessions, app.config['SESSION_SWEEP_INTERVAL'])
+schedule('sweep-idempotency-keys', sweep_idempotency_keys, app.config['IDEMPOTENCY_SWEEP_INTERVAL'])
+schedule('balance-snapshots', take_balance_snapshots, app.config['BALANCE_SNAPSHOT_INTERVAL'])
+schedule('transaction-partitions', manage_transaction_partitions, app.config['TRANSACTION_PARTITIONS_INTERVAL'])
+schedule('archive-payments', archive_payments, app.config['PAYMENT_ARCHIVE_INTERVAL'])
+
+
+@app.before_first_request
+def start_maintenance():
+    start_jobs()
+
+
+@app.cli.command('sweep-sessions')
+@click.option('--batch-size', default=None, type=int, help='Sessions deleted per transaction')
+def sweep_sessions_command(batch_size):
+    """Delete the expired sessions"""
+    click.echo('Reclaimed {} expired sessions'.format(sweep_expired_sessions(batch_size)))
+
+
+@app.cli.command('sweep-idempotency-keys')
+@click.option('--batch-size', default=None, type=int, help='Keys deleted per transaction')
+def sweep_idempotency_keys_command(batch_size):
+    """Delete the expired idempotency keys"""
+    click.echo('Deleted {} expired idempotency keys'.format(sweep_idempotency_keys(batch_size)))
+
+
+@app.cli.command('snapshot-balances')
+def snapshot_balances_command():
+    """Fold the new ledger entries into the balance snapshots"""
+    click.echo('Snapshotted the balance of {} accounts'.format(take_balance_snapshots()))
+
+
+@app.cli.command('manage-partitions')
+def manage_partitions_command():
+    """Create the next partitions of transaction and detach the old ones"""
+    result = manage_transaction_partitions()
+    click.echo('Created {}, detached {}'.format(', '.join(result['created']) or 'none', ', '.join(result['detached']) or 'none'))
+
+
+@app.cli.command('archive-payments')
+@click.option('--batch-size', default=None, type=int, help='Payments archived per transaction')
+def archive_payments_command(batch_size):
+    """Move the old completed and cancelled payments to the archive"""
+    click.echo('Archived {} payments'.format(archive_payments(batch_size)))
@@ -0,0 +1,346 @@
+# server/migrations.py
+
+import zlib
+import click
+from iso4217 import Currency
+from server import app, db
+from server.models import Account
+
+
+def enum_type(name, values):
+    """
+        CREATE TYPE ... AS ENUM that does nothing when the type already exists
+    """
+    labels = ', '.join("'{}'".format(value) for value in values)
+    return """
+        DO $$ BEGIN
+            CREATE TYPE {} AS ENUM ({});
+        EXCEPTION WHEN duplicate_object THEN NULL;
+        END $$
+    """.format(name, labels)
+
+
+# The schema steps, in order. A step is never edited once shipped, a change is a new step.
+# Every statement can run again on a database that already has it, so a step that failed
+# halfway is simply applied again.
+MIGRATIONS = [
+    (1, 'baseline schema', [
+        'CREATE EXTENSION IF NOT EXISTS "uuid-ossp"',
+        enum_type('currency', [currency.name for currency in Currency]),
+        enum_type('paymentstate', ['pending', 'requested', 'completed', 'cancelled', 'authorized']),
+        enum_type('transactionstate', ['created', 'accepted', 'completed', 'failed', 'cancelled', 'authorized']),
+        enum_type('entrykind', ['deposit', 'payment', 'receipt']),
+        """
+        CREATE TABLE IF NOT EXISTS account (
+            id UUID DEFAULT uuid_generate_v4() PRIMARY KEY,
+            user_id VARCHAR(255) NOT NULL UNIQUE,
+            password VARCHAR(255) NOT NULL,
+            currency currency NOT NULL,
+            state BOOLEAN NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS active_sessions (
+            id SERIAL PRIMARY KEY,
+            token_hash BYTEA NOT NULL UNIQUE,
+            refresh_hash BYTEA NOT NULL UNIQUE,
+            user_id VARCHAR(255) NOT NULL UNIQUE,
+            emission_at TIMESTAMP NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            id BIGSERIAL PRIMARY KEY,
+            account_id UUID REFERENCES account (id),
+            amount BIGINT NOT NULL,
+            kind entrykind NOT NULL,
+            payment_id UUID,
+            transaction_id UUID,
+            created_at TIMESTAMP NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            account_id UUID PRIMARY KEY REFERENCES account (id),
+            entry_id BIGINT NOT NULL,
+            balance BIGINT NOT NULL,
+            taken_at TIMESTAMP NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payment (
+            id UUID DEFAULT uuid_generate_v4() PRIMARY KEY,
+            request_id VARCHAR(40),
+            account_id UUID NOT NULL REFERENCES account (id),
+            receiver_id UUID NOT NULL REFERENCES account (id),
+            created_at TIMESTAMP NOT NULL,
+            completed_at TIMESTAMP,
+            state paymentstate NOT NULL,
+            amount BIGINT NOT NULL,
+            currency currency NOT NULL,
+            reference VARCHAR(128)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transaction (
+            id UUID DEFAULT uuid_generate_v4() PRIMARY KEY,
+            amount BIGINT NOT NULL,
+            emission_date TIMESTAMP NOT NULL,
+            state transactionstate NOT NULL,
+            update_date TIMESTAMP NOT NULL,
+            id_payment UUID NOT NULL REFERENCES payment (id),
+            reference VARCHAR(128)
+        )
+        """
+    ]),
+    (2, 'session and ledger indexes', [
+        'CREATE INDEX IF NOT EXISTS ix_active_sessions_emission_at ON active_sessions (emission_at)',
+        'CREATE INDEX IF NOT EXISTS ix_ledger_entries_account_id_id ON ledger_entries (account_id, id)'
+    ]),
+    (3, 'payment and transaction lookup indexes', [
+        'CREATE INDEX IF NOT EXISTS ix_transaction_id_payment_state ON transaction (id_payment, state)',
+        'CREATE INDEX IF NOT EXISTS ix_payment_account_id_created_at ON payment (account_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS ix_payment_receiver_id ON payment (receiver_id)'
+    ]),
+    (4, 'monthly partitions of transaction', [
+        """
+        CREATE OR REPLACE FUNCTION create_transaction_partition(month TIMESTAMP) RETURNS TEXT AS $$
+        DECLARE
+            first_day TIMESTAMP := date_trunc('month', month);
+            partition_name TEXT := 'transaction_' || to_char(month, 'YYYY_MM');
+        BEGIN
+            IF to_regclass(partition_name) IS NOT NULL THEN
+                RETURN NULL;
+            END IF;
+            EXECUTE 'CREATE TABLE ' || quote_ident(partition_name) || ' PARTITION OF transaction FOR VALUES FROM ('
+                    || quote_literal(first_day) || ') TO (' || quote_literal(first_day + interval '1 month') || ')';
+            RETURN partition_name;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DO $$
+        DECLARE
+            month TIMESTAMP;
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'transaction'::regclass) THEN
+                RETURN;
+            END IF;
+
+            ALTER TABLE transaction RENAME TO transaction_unpartitioned;
+            ALTER TABLE transaction_unpartitioned RENAME CONSTRAINT transaction_pkey TO transaction_unpartitioned_pkey;
+            DROP INDEX IF EXISTS ix_transaction_id_payment_state;
+
+            CREATE TABLE transaction (
+                id UUID DEFAULT uuid_generate_v4() NOT NULL,
+                amount BIGINT NOT NULL,
+                emission_date TIMESTAMP NOT NULL,
+                state transactionstate NOT NULL,
+                update_date TIMESTAMP NOT NULL,
+                id_payment UUID NOT NULL REFERENCES payment (id),
+                reference VARCHAR(128),
+                PRIMARY KEY (id, emission_date)
+            ) PARTITION BY RANGE (emission_date);
+
+            FOR month IN
+                SELECT generate_series(first_month, date_trunc('month', now()), interval '1 month')
+                FROM (SELECT date_trunc('month', coalesce(min(emission_date), now())) AS first_month
+                      FROM transaction_unpartitioned) bounds
+            LOOP
+                PERFORM create_transaction_partition(month);
+            END LOOP;
+
+            INSERT INTO transaction (id, amount, emission_date, state, update_date, id_payment, reference)
+            SELECT id, amount, emission_date, state, update_date, id_payment, reference
+            FROM transaction_unpartitioned;
+
+            DROP TABLE transaction_unpartitioned;
+        END $$
+        """,
+        """
+        SELECT create_transaction_partition(date_trunc('month', now()) + n * interval '1 month')
+        FROM generate_series(1, 3) n
+        """,
+        'CREATE INDEX IF NOT EXISTS ix_transaction_id_payment_state ON transaction (id_payment, state)'
+    ]),
+    (5, 'payment archive', [
+        """
+        CREATE TABLE IF NOT EXISTS payment_archive (
+            id UUID PRIMARY KEY,
+            account_id UUID NOT NULL,
+            receiver_id UUID NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            archived_at TIMESTAMP NOT NULL,
+            document BYTEA NOT NULL
+        )
+        """,
+        'CREATE INDEX IF NOT EXISTS ix_payment_archive_account_id_created_at ON payment_archive (account_id, created_at)'
+    ]),
+    (6, 'authorized payments index for the settlement', [
+        "CREATE INDEX IF NOT EXISTS ix_payment_authorized_created_at_id ON payment (created_at, id) WHERE state = 'authorized'"
+    ]),
+    (7, 'idempotency keys', [
+        """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            account_id UUID NOT NULL REFERENCES account (id),
+            key VARCHAR(255) NOT NULL,
+            fingerprint VARCHAR(64) NOT NULL,
+            status INTEGER,
+            response TEXT,
+            created_at TIMESTAMP NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (account_id, key)
+        )
+        """,
+        'CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at ON idempotency_keys (expires_at)'
+    ]),
+    (8, 'keyset pagination indexes', [
+        'CREATE INDEX IF NOT EXISTS ix_payment_account_id_created_at_id ON payment (account_id, created_at, id)',
+        'DROP INDEX IF EXISTS ix_payment_account_id_created_at',
+        'CREATE INDEX IF NOT EXISTS ix_payment_archive_account_id_created_at_id ON payment_archive (account_id, created_at, id)',
+        'DROP INDEX IF EXISTS ix_payment_archive_account_id_created_at',
+        'CREATE INDEX IF NOT EXISTS ix_transaction_id_payment_emission_date_id ON transaction (id_payment, emission_date, id)'
+    ]),
+    (9, 'default partition of transaction', [
+        """
+        CREATE OR REPLACE FUNCTION create_transaction_partition(month TIMESTAMP) RETURNS TEXT AS $$
+        DECLARE
+            first_day TIMESTAMP := date_trunc('month', month);
+            next_month TIMESTAMP := date_trunc('month', month) + interval '1 month';
+            partition_name TEXT := 'transaction_' || to_char(month, 'YYYY_MM');
+        BEGIN
+            IF to_regclass(partition_name) IS NOT NULL THEN
+                RETURN NULL;
+            END IF;
+
+            -- the rows of the month that went to the default partition move to the new one, postgres
+            -- refuses to attach it while the default partition has rows of its range
+            EXECUTE 'CREATE TABLE ' || quote_ident(partition_name) || ' (LIKE transaction INCLUDING DEFAULTS)';
+            IF to_regclass('transaction_default') IS NOT NULL THEN
+                EXECUTE 'WITH moved AS (DELETE FROM transaction_default WHERE emission_date >= $1 AND emission_date < $2 '
+                        || 'RETURNING *) INSERT INTO ' || quote_ident(partition_name) || ' SELECT * FROM moved'
+                USING first_day, next_month;
+            END IF;
+            EXECUTE 'ALTER TABLE transaction ATTACH PARTITION ' || quote_ident(partition_name) || ' FOR VALUES FROM ('
+                    || quote_literal(first_day) || ') TO (' || quote_literal(next_month) || ')';
+            RETURN partition_name;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        'CREATE TABLE IF NOT EXISTS transaction_default PARTITION OF transaction DEFAULT'
+    ]),
+    (10, 'one session per login', [
+        'ALTER TABLE active_sessions DROP CONSTRAINT IF EXISTS active_sessions_user_id_key',
+        'CREATE INDEX IF NOT EXISTS ix_active_sessions_user_id ON active_sessions (user_id)'
+    ])
+]
+
+LOCK_KEY = zlib.crc32(b'schema-migrations')
+
+# The accounts of the carriers, created once by "flask seed"
+CARRIERS = ['transdev', 'cp', 'metro']
+
+
+def applied_versions(connection):
+    return {row[0] for row in connection.execute('SELECT version FROM schema_migrations')}
+
+
+def migrate(engine, target=None):
+    """
+        Applies the steps missing from schema_migrations, each one in its own transaction
+        together with the row that records it. An advisory lock serializes concurrent runs,
+        the later ones find the steps already applied.
+
+        :param target: the last version to apply, all of them when None
+        :return: list of the (version, name) applied
+    """
+    applied = []
+
+    with engine.connect() as connection:
+        connection.execute('SELECT pg_advisory_lock(%s)', LOCK_KEY)
+        try:
+            # building an index on a large table takes longer than the timeout of the requests
+            connection.execute('SET statement_timeout = 0')
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name VARCHAR(128) NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT now()
+                )
+            """)
+            done = applied_versions(connection)
+
+            for version, name, statements in MIGRATIONS:
+                if version in done or (target is not None and version > target):
+                    continue
+
+                with connection.begin():
+                    for statement in statements:
+                        connection.execute(db.text(statement))
+                    connection.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', version, name)
+
+                app.logger.info('Applied migration %d %s', version, name)
+                applied.append((version, name))
+        finally:
+            connection.execute('RESET statement_timeout')
+            connection.execute('SELECT pg_advisory_unlock(%s)', LOCK_KEY)
+
+    return applied
+
+
+def pending(engine):
+    """
+        The (version, name) of the steps not applied yet
+    """
+    with engine.connect() as connection:
+        exists = connection.execute("SELECT to_regclass('schema_migrations')").scalar()
+        done = applied_versions(connection) if exists else set()
+    return [(version, name) for version, name, _ in MIGRATIONS if version not in done]
+
+
+@app.cli.command('migrate')
+@click.option('--target', default=None, type=int, help='Last version to apply')
+@click.option('--status', is_flag=True, help='Only list the pending versions')
+def migrate_command(target, status):
+    """Apply the pending schema migrations"""
+    if status:
+        for version, name in pending(db.engine):
+            click.echo('pending {} {}'.format(version, name))
+        return
+
+    applied = migrate(db.engine, target)
+    for version, name in applied:
+        click.echo('applied {} {}'.format(version, name))
+    if not applied:
+        click.echo('The database is up to date')
+
+
+def seed_carriers():
+    """
+        Creates the carrier accounts that do not exist yet, under the migrations lock
+        :return: the user ids created
+    """
+    created = []
+
+    with db.engine.connect() as connection:
+        connection.execute('SELECT pg_advisory_lock(%s)', LOCK_KEY)
+        try:
+            existing = {user_id for user_id, in db.session.query(Account.user_id).filter(Account.user_id.in_(CARRIERS))}
+            for user_id in CARRIERS:
+                if user_id not in existing:
+                    db.session.add(Account(user_id=user_id, password=user_id, currency=Currency('EUR')))
+                    created.append(user_id)
+            db.session.commit()
+        finally:
+            connection.execute('SELECT pg_advisory_unlock(%s)', LOCK_KEY)
+
+    return created
+
+
+@app.cli.command('seed')
+def seed_command():
+    """Create the carrier accounts"""
+    created = seed_carriers()
+    click.echo('Created the accounts {}'.format(', '.join(created)) if created else 'The accounts already exist')
@@ -3,24 +3,21 @@
 import os
 import uuid
 import enum
+import json
+import zlib
 import jwt
 import datetime
+import time
+import secrets
 from iso4217 import Currency
-from sqlalchemy.dialects.postgresql import UUID
-from server import db, bcrypt, app
+from sqlalchemy.dialects.postgresql import UUID, insert as pg_insert
+from server import db, hasher, app
+from server.cache import LRUCache
+from server.session_store import create_session_store, token_digest
 
 
-@app.before_first_request
-def initialize_database():
-
-    ac = Account(user_id='transdev', password='transdev', currency=Currency('EUR'))
-    ac.save_to_db()
-
-    ac = Account(user_id='cp', password='cp', currency=Currency('EUR'))
-    ac.save_to_db()
-
-    ac = Account(user_id='metro', password='metro', currency=Currency('EUR'))
-    ac.save_to_db()
+# Verified tokens of this worker, mapped to the account id they were issued for
+token_cache = LRUCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
 
 
 class PaymentState(enum.Enum):
@@ -40,6 +37,53 @@ class TransactionState(enum.Enum):
     authorized = "authorized"
 
 
+# The states a payment or a transaction can move to from each state. Every change of state is a
+# conditional UPDATE ... WHERE state IN (the states allowed to reach the target), so a request that
+# loses a race against another one changes nothing and gets a StateConflict.
+PAYMENT_TRANSITIONS = {
+    PaymentState.pending: {PaymentState.requested, PaymentState.cancelled},
+    PaymentState.requested: {PaymentState.authorized, PaymentState.cancelled},
+    PaymentState.authorized: {PaymentState.completed, PaymentState.cancelled},
+    PaymentState.completed: set(),
+    PaymentState.cancelled: set()
+}
+
+TRANSACTION_TRANSITIONS = {
+    TransactionState.created: {TransactionState.accepted, TransactionState.authorized, TransactionState.cancelled},
+    TransactionState.accepted: {TransactionState.authorized, TransactionState.cancelled},
+    TransactionState.authorized: {TransactionState.completed, TransactionState.failed, TransactionState.cancelled},
+    TransactionState.completed: set(),
+    TransactionState.failed: set(),
+    TransactionState.cancelled: set()
+}
+
+
+def sources(transitions, target):
+    """
+        The states allowed to move to target
+    """
+    return [state for state, targets in transitions.items() if target in targets]
+
+
+class StateConflict(Exception):
+    """
+        Raised when a payment or transaction is not in a state that can move to the target one,
+        because the transition is not allowed or a concurrent request changed it first
+    """
+
+    def __init__(self, current, target):
+        # current is None when the row does not exist
+        self.current = current
+        self.target = target
+        super().__init__('Can not move from {} to {}'.format(current.name if current else None, target.name))
+
+
+class EntryKind(enum.Enum):
+    deposit = "deposit"
+    payment = "payment"
+    receipt = "receipt"
+
+
 # MODELS
 class BaseModel(db.Model):
     """
@@ -73,35 +117,63 @@ class Active_Sessions(BaseModel, db.Model):
     __tablename__ = 'active_sessions'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    # User token
-    token = db.Column(db.String(500), unique=True, nullable=False)
-    # The user id
-    user_id = db.Column(db.String(255), unique=True, nullable=False)
-    # Date emission
-    emission_at = db.Column(db.DateTime, nullable=False)
-
-    def __init__(self, token, user_id):
-        self.token = str(token)
+    # SHA-256 of the user token
+    token_hash = db.Column(db.LargeBinary(32), unique=True, nullable=False)
+    # SHA-256 of the opaque refresh token
+    refresh_hash = db.Column(db.LargeBinary(32), unique=True, nullable=False)
+    # The user id, a user has one session per login
+    user_id = db.Column(db.String(255), nullable=False, index=True)
+    # Date emission of the tokens, the expired sessions are swept by it
+    emission_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __init__(self, token_hash, refresh_hash, user_id):
+        self.token_hash = token_hash
+        self.refresh_hash = refresh_hash
         self.user_id = user_id
         self.emission_at = datetime.datetime.now()
 
     def __repr__(self):
-        return '<id: token: {}'.format(self.token)
+        return '<id: token_hash: {}'.format(self.token_hash.hex())
 
     @staticmethod
-    def check_active_session(auth_token):
-        # check whether auth token has been listed
-        res = Active_Sessions.query.filter_by(token=str(auth_token)).first()
-        if res:
-            return True
-        else:
-            return False
+    def generate_refresh_token():
+        """
+            Opaque refresh token, only its digest is stored
+        """
+        return secrets.token_urlsafe(32)
+
+    @staticmethod
+    def rotate(refresh_hash, next_refresh_hash):
+        """
+            Swaps the refresh token of a session that did not expire in one conditional UPDATE ... RETURNING.
+            Of two refreshes with the same token only the first one matches, the other waits for the row
+            lock and then finds the token gone.
+
+            :return: (id, user_id, token_hash) of the session, with the token_hash it had so far, or None
+        """
+        table = Active_Sessions.__table__
+        now = datetime.datetime.now()
+        lifetime = datetime.timedelta(seconds=app.config['REFRESH_TOKEN_LIFETIME'])
+        return db.session.execute(
+            table.update()
+            .where(db.and_(table.c.refresh_hash == refresh_hash, table.c.emission_at > now - lifetime))
+            .values(refresh_hash=next_refresh_hash, emission_at=now)
+            .returning(table.c.id, table.c.user_id, table.c.token_hash)).first()
+
+    @staticmethod
+    def set_token(session_id, token_hash):
+        Active_Sessions.query.filter_by(id=session_id) \
+            .update({Active_Sessions.token_hash: token_hash}, synchronize_session=False)
 
     def save_to_db(self):
         db.session.add(self)
         db.session.commit()
 
 
+# Active sessions, looked up in the backend chosen by SESSION_STORE
+session_store = create_session_store(app, db, Active_Sessions)
+
+
 class Account(BaseModel, db.Model):
     """
         Model for the account table
@@ -114,8 +186,6 @@ class Account(BaseModel, db.Model):
     user_id = db.Column(db.String(255), unique=True, nullable=False)
     # The password
     password = db.Column(db.String(255), nullable=False)
-    # The ammount in his account
-    balance = db.Column(db.Float, default=0.0, nullable=False)
     # The atual currency
     currency = db.Column(db.Enum(Currency), default=Currency.eur, nullable=False) 
     # The state of the account : active or inactive
@@ -127,8 +197,7 @@ class Account(BaseModel, db.Model):
 
     def __init__(self, user_id, password, currency):
         self.user_id = user_id
-        self.password = bcrypt.generate_password_hash(password, app.config['BCRYPT_LOG_ROUNDS']).decode()
-        self.balance = 0.0
+        self.password = hasher.generate_password_hash(password, app.config['BCRYPT_LOG_ROUNDS'])
         self.currency = currency
         self.state = True
         self.created_at = self.updated_at = datetime.datetime.utcnow().isoformat()
@@ -152,7 +221,7 @@ class Account(BaseModel, db.Model):
         """
         try:
             payload = {
-                'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1, seconds=3600),
+                'exp': datetime.datetime.utcnow() + datetime.timedelta(seconds=app.config['AUTH_TOKEN_LIFETIME']),
                 'iat': datetime.datetime.utcnow(),
                 'sub': str(user_id)
             }
@@ -160,33 +229,196 @@ class Account(BaseModel, db.Model):
         except Exception as e:
             return e
     
-    @staticmethod
-    def decode_auth_token(auth_token):
+    @classmethod
+    def authenticate(cls, auth_token):
         """
-            Validates the auth token
+            Validates the auth token and loads the account it was issued for
             :param auth_token:
-            :return: integer|string
+            :return: Account|None
         """
+        token_hash = token_digest(auth_token)
+
+        # The cache only serves the sessions known on this node, a logout on any worker discards them
+        # from the shared table. The database store knows none, so it never looks the cache up.
+        known = session_store.contains_locally(token_hash)
+        subject = token_cache.get(auth_token) if known else None
+        if subject is not None:
+            return cls.query.get(uuid.UUID(subject))
+
         try:
             payload = jwt.decode(auth_token, app.config['SECRET_KEY'])
-            is_active_token = Active_Sessions.check_active_session(auth_token)
-            if not is_active_token:
-                return 'Token invalid.'
-            else:
-                return payload['sub'] 
-        except jwt.ExpiredSignatureError:
-            return 'Signature expired. Please log in again.'
         except jwt.InvalidTokenError:
-            return 'Invalid token. Please log in again.'
+            return None
+
+        if known:
+            account = cls.query.get(uuid.UUID(payload['sub']))
+        else:
+            # the session check and the account load share one query
+            account = cls.query \
+                .join(Active_Sessions, Active_Sessions.user_id == cls.user_id) \
+                .filter(cls.id == payload['sub'], Active_Sessions.token_hash == token_hash) \
+                .first()
+            known = account is not None and session_store.remember(token_hash)
+
+        if known and account is not None:
+            # never keep a token in the cache after it expires
+            token_cache.set(auth_token, payload['sub'], ttl=payload['exp'] - time.time())
+        return account
+
+    @staticmethod
+    def deposit(account_id, amount):
+        """
+            Appends the entries of money coming into the account from outside the service
+            :param amount: integer of minor units of the account currency
+        """
+        Ledger_Entries.append([
+            Ledger_Entries.entry(None, -amount, EntryKind.deposit),
+            Ledger_Entries.entry(account_id, amount, EntryKind.deposit)
+        ])
+
+    @staticmethod
+    def transfer(payer_id, payee_id, legs, payment_id=None):
+        """
+            Appends the entries of a payment, one debit and one credit per transaction, when the payer
+            has enough money. The payer row stays locked until the end of the database transaction,
+            so two payments of the same payer can not both spend the same balance.
+
+            :param legs: list of (transaction id, amount in minor units)
+            :return: True, or False when the payer balance is not enough
+        """
+        db.session.query(Account.id).filter(Account.id == payer_id).with_for_update().one()
+
+        if Ledger_Entries.balance(payer_id) < sum(amount for _, amount in legs):
+            return False
+
+        entries = []
+        for transaction_id, amount in legs:
+            entries.append(Ledger_Entries.entry(payer_id, -amount, EntryKind.payment, payment_id, transaction_id))
+            entries.append(Ledger_Entries.entry(payee_id, amount, EntryKind.receipt, payment_id, transaction_id))
+        # a payment whose transactions were all cancelled moves no money
+        if entries:
+            Ledger_Entries.append(entries)
+        return True
+
+    def available_balance(self):
+        """
+            The balance of the account, in minor units: its last snapshot plus the ledger entries after it
+        """
+        return Ledger_Entries.balance(self.id)
 
     def check_password_hash(hash, password):
-        return bcrypt.check_password_hash(hash, password)
+        return hasher.check_password_hash(hash, password)
+
+    def needs_rehash(self):
+        """
+            True when the password was hashed with a cost lower than the one of this deployment
+        """
+        return hasher.needs_rehash(self.password)
+
+    def set_password(self, password):
+        self.password = hasher.generate_password_hash(password, app.config['BCRYPT_LOG_ROUNDS'])
+        self.updated_at = datetime.datetime.utcnow().isoformat()
 
     def save_to_db(self):
         db.session.add(self)
         db.session.commit()
 
 
+class Ledger_Entries(BaseModel, db.Model):
+    """
+        Model for the ledger, append only. Every movement of money is a set of entries that sum
+        to zero; the entries without account are the money coming from outside the service.
+    """
+    __tablename__ = 'ledger_entries'
+
+    # The entry id, increasing in the order the entries were appended
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    # The account, None for the outside of the service
+    account_id = db.Column(UUID(as_uuid=True), db.ForeignKey("account.id"))
+    # The amount in minor units of the account currency, positive for a credit and negative for a debit
+    amount = db.Column(db.BigInteger, nullable=False)
+    # What made the money move
+    kind = db.Column(db.Enum(EntryKind), nullable=False)
+    # The payment and the transaction settled, for payments and receipts
+    payment_id = db.Column(UUID(as_uuid=True))
+    transaction_id = db.Column(UUID(as_uuid=True))
+    # The date of the entry
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_ledger_entries_account_id_id', 'account_id', 'id'),
+    )
+
+    @staticmethod
+    def entry(account_id, amount, kind, payment_id=None, transaction_id=None):
+        return {
+            'account_id': account_id,
+            'amount': amount,
+            'kind': kind,
+            'payment_id': payment_id,
+            'transaction_id': transaction_id,
+            'created_at': datetime.datetime.utcnow()
+        }
+
+    @staticmethod
+    def append(entries):
+        """
+            Inserts the entries with a single multi-row INSERT, in the current transaction
+        """
+        db.session.execute(Ledger_Entries.__table__.insert().values(entries))
+
+    @staticmethod
+    def balance(account_id):
+        """
+            The last snapshot of the account plus the entries appended after it.
+            The cost depends on the entries since the last snapshot, not on the whole history.
+        """
+        snapshot = db.session.query(Balance_Snapshots.balance, Balance_Snapshots.entry_id) \
+            .filter(Balance_Snapshots.account_id == account_id) \
+            .first()
+        balance, entry_id = snapshot if snapshot else (0, 0)
+
+        # the sum of a bigint column is a numeric, cast it back so no Decimal reaches Python
+        tail = db.session.query(db.cast(db.func.coalesce(db.func.sum(Ledger_Entries.amount), 0), db.BigInteger)) \
+            .filter(Ledger_Entries.account_id == account_id) \
+            .filter(Ledger_Entries.id > entry_id) \
+            .scalar()
+        return balance + tail
+
+    @staticmethod
+    def balances(account_ids):
+        """
+            The balances of several accounts with a single query, computed like balance
+            :return: dict of account id to balance in minor units
+        """
+        tail = db.session.query(db.func.coalesce(db.func.sum(Ledger_Entries.amount), 0)) \
+            .filter(Ledger_Entries.account_id == Account.id) \
+            .filter(Ledger_Entries.id > db.func.coalesce(Balance_Snapshots.entry_id, 0)) \
+            .correlate(Account, Balance_Snapshots) \
+            .as_scalar()
+
+        rows = db.session.query(Account.id, db.cast(db.func.coalesce(Balance_Snapshots.balance, 0) + tail, db.BigInteger)) \
+            .outerjoin(Balance_Snapshots, Balance_Snapshots.account_id == Account.id) \
+            .filter(Account.id.in_(account_ids))
+        return dict(rows)
+
+
+class Balance_Snapshots(BaseModel, db.Model):
+    """
+        Model for the balance of each account up to a ledger entry, refreshed periodically
+    """
+    __tablename__ = 'balance_snapshots'
+
+    # The account id
+    account_id = db.Column(UUID(as_uuid=True), db.ForeignKey("account.id"), primary_key=True)
+    # The last ledger entry included in the balance
+    entry_id = db.Column(db.BigInteger, nullable=False)
+    # The balance up to that entry, in minor units
+    balance = db.Column(db.BigInteger, nullable=False)
+    # The date of the snapshot
+    taken_at = db.Column(db.DateTime, nullable=False)
+
+
 class Payment(BaseModel, db.Model):
     """
         Model for the payment table
@@ -207,8 +439,8 @@ class Payment(BaseModel, db.Model):
     completed_at = db.Column(db.DateTime)
     # The state of the payment
     state = db.Column(db.Enum(PaymentState), nullable=False)
-    # The amount who will be paid
-    amount = db.Column(db.Float, nullable=False)
+    # The amount who will be paid, in minor units of the currency
+    amount = db.Column(db.BigInteger, nullable=False)
     # The currency
     currency = db.Column(db.Enum(Currency), nullable=False) 			
     # An optional textual reference shown on the transaction
@@ -217,6 +449,13 @@ class Payment(BaseModel, db.Model):
     buyer = db.relationship("Account", foreign_keys=account_id)
     seller = db.relationship("Account", foreign_keys=receiver_id)
 
+    __table_args__ = (
+        db.Index('ix_payment_account_id_created_at_id', 'account_id', 'created_at', 'id'),
+        db.Index('ix_payment_receiver_id', 'receiver_id'),
+        db.Index('ix_payment_authorized_created_at_id', 'created_at', 'id',
+                 postgresql_where=db.text("state = 'authorized'")),
+    )
+
     def __init__(self, request_id, account_id, receiver_id, currency, reference):
         self.id = uuid.uuid4()
         self.request_id = request_id
@@ -224,7 +463,7 @@ class Payment(BaseModel, db.Model):
         self.receiver_id = receiver_id
         self.created_at = datetime.datetime.utcnow().isoformat()
         self.state = PaymentState.pending
-        self.amount = 0.0
+        self.amount = 0
         self.currency = currency
         self.reference = reference
 
@@ -232,9 +471,44 @@ class Payment(BaseModel, db.Model):
         db.session.add(self)
         db.session.commit()
 
-    def update_state(self, value):
-        self.state = PaymentState(value)
-        db.session.commit()
+    @staticmethod
+    def transition(payment_id, to_state, account_id=None):
+        """
+            Moves the payment to to_state in one conditional UPDATE ... RETURNING, which also keeps
+            the row locked until the end of the database transaction
+
+            :param account_id: when given, only a payment of this buyer is moved
+            :return: (account_id, receiver_id, amount) of the payment
+            :raise StateConflict: when the payment was not in a state that can move to to_state
+        """
+        table = Payment.__table__
+        values = {'state': to_state}
+        if to_state == PaymentState.completed:
+            values['completed_at'] = datetime.datetime.utcnow()
+
+        condition = [table.c.id == payment_id, table.c.state.in_(sources(PAYMENT_TRANSITIONS, to_state))]
+        if account_id is not None:
+            condition.append(table.c.account_id == account_id)
+
+        row = db.session.execute(
+            table.update().where(db.and_(*condition)).values(**values)
+            .returning(table.c.account_id, table.c.receiver_id, table.c.amount)).first()
+
+        if row is None:
+            # only when it failed, read why
+            current = db.session.query(Payment.state).filter(Payment.id == payment_id)
+            if account_id is not None:
+                current = current.filter(Payment.account_id == account_id)
+            raise StateConflict(current.scalar(), to_state)
+        return row
+
+    @staticmethod
+    def add_to_amount(payment_id, amount):
+        """
+            Adds minor units to the amount of the payment in the database, so no concurrent change is lost
+        """
+        Payment.query.filter(Payment.id == payment_id) \
+            .update({Payment.amount: Payment.amount + amount}, synchronize_session=False)
 
     def json(self):
         """
@@ -253,10 +527,10 @@ class Transaction(BaseModel, db.Model):
 
     # The id of the transaction
     id = db.Column(UUID(as_uuid=True),server_default=db.text("uuid_generate_v4()"), primary_key=True)
-    # The amount of the transaction
-    amount = db.Column(db.Float, nullable=False)
-    # Emission date of the transaction
-    emission_date = db.Column(db.DateTime, nullable=False)
+    # The amount of the transaction, in minor units of the payment currency
+    amount = db.Column(db.BigInteger, nullable=False)
+    # Emission date of the transaction, the table is partitioned by its month so it is part of the key
+    emission_date = db.Column(db.DateTime, primary_key=True)
     # The state of the transaction
     state = db.Column(db.Enum(TransactionState), nullable=False)
     # The update date of the transaction
@@ -268,6 +542,12 @@ class Transaction(BaseModel, db.Model):
     
     payment = db.relationship("Payment", foreign_keys=id_payment)
 
+    __table_args__ = (
+        db.Index('ix_transaction_id_payment_state', 'id_payment', 'state'),
+        db.Index('ix_transaction_id_payment_emission_date_id', 'id_payment', 'emission_date', 'id'),
+        {'postgresql_partition_by': 'RANGE (emission_date)'}
+    )
+
     def __init__(self, amount, id_payment, reference):
         self.amount = amount
         self.emission_date = datetime.datetime.now()
@@ -280,6 +560,216 @@ class Transaction(BaseModel, db.Model):
         db.session.add(self)
         db.session.commit()
 
-    def update_state(self, value):
-        self.state = TransactionState(value)
-        db.session.commit()
+    @staticmethod
+    def create_many(payment_id, legs):
+        """
+            Inserts the transactions of a payment with a single multi-row INSERT ... RETURNING
+            :param legs: list of (amount in minor units, reference)
+            :return: the ids of the new transactions, in the order of the legs
+        """
+        now = datetime.datetime.now()
+        rows = [
+            {
+                'amount': amount,
+                'emission_date': now,
+                'state': TransactionState.created,
+                'update_date': now,
+                'id_payment': payment_id,
+                'reference': reference
+            } for amount, reference in legs
+        ]
+        result = db.session.execute(Transaction.__table__.insert().values(rows).returning(Transaction.__table__.c.id))
+        return [transaction_id for transaction_id, in result]
+
+    @staticmethod
+    def find_in_payment(payment_id, transaction_id):
+        """
+            The transaction of a payment. The key also has the emission date, so it is not a query.get
+        """
+        return Transaction.query.filter_by(id=transaction_id, id_payment=payment_id).first()
+
+    @staticmethod
+    def transition(payment_id, from_state, to_state):
+        """
+            Moves every transaction of the payment in from_state to to_state with a single
+            UPDATE ... RETURNING, in the current database transaction
+            :return: list of (id, amount) of the transactions moved
+        """
+        if to_state not in TRANSACTION_TRANSITIONS[from_state]:
+            raise StateConflict(from_state, to_state)
+
+        table = Transaction.__table__
+        result = db.session.execute(
+            table.update()
+            .where(db.and_(table.c.id_payment == payment_id, table.c.state == from_state))
+            .values(state=to_state, update_date=datetime.datetime.now())
+            .returning(table.c.id, table.c.amount))
+        return [(transaction_id, amount) for transaction_id, amount in result]
+
+    @staticmethod
+    def transition_one(payment_id, transaction_id, to_state):
+        """
+            Moves one transaction of the payment to to_state in one conditional UPDATE ... RETURNING
+            :return: the amount of the transaction
+            :raise StateConflict: when the transaction was not in a state that can move to to_state
+        """
+        table = Transaction.__table__
+        row = db.session.execute(
+            table.update()
+            .where(db.and_(table.c.id == transaction_id, table.c.id_payment == payment_id,
+                           table.c.state.in_(sources(TRANSACTION_TRANSITIONS, to_state))))
+            .values(state=to_state, update_date=datetime.datetime.now())
+            .returning(table.c.amount)).first()
+
+        if row is None:
+            # only when it failed, read why
+            current = db.session.query(Transaction.state) \
+                .filter(Transaction.id == transaction_id, Transaction.id_payment == payment_id) \
+                .scalar()
+            raise StateConflict(current, to_state)
+        return row.amount
+
+
+class Payment_Archive(BaseModel, db.Model):
+    """
+        Model for the archived payments: a completed or cancelled payment and its transactions
+        as compressed JSON, out of the tables and indexes the handlers use
+    """
+    __tablename__ = 'payment_archive'
+
+    # The payment id
+    id = db.Column(UUID(as_uuid=True), primary_key=True)
+    # The buyer account
+    account_id = db.Column(UUID(as_uuid=True), nullable=False)
+    # The seller account
+    receiver_id = db.Column(UUID(as_uuid=True), nullable=False)
+    # The date when the payment was made
+    created_at = db.Column(db.DateTime, nullable=False)
+    # The date when the payment was archived
+    archived_at = db.Column(db.DateTime, nullable=False)
+    # The payment and its transactions, zlib compressed JSON
+    document = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_payment_archive_account_id_created_at_id', 'account_id', 'created_at', 'id'),
+    )
+
+    @staticmethod
+    def pack(payment, transactions):
+        """
+            The archive row of a payment, to insert with Payment_Archive.__table__.insert()
+        """
+        document = {
+            'id': str(payment.id),
+            'request': payment.request_id,
+            'seller': str(payment.receiver_id),
+            'state': payment.state.name,
+            'amount': payment.amount,
+            'currency': payment.currency.name,
+            'reference': payment.reference,
+            'transactions': [
+                {
+                    'id': str(transaction.id),
+                    'amount': transaction.amount,
+                    'emission_date': transaction.emission_date.isoformat(),
+                    'state': transaction.state.name,
+                    'update_date': transaction.update_date.isoformat(),
+                    'reference': transaction.reference
+                } for transaction in transactions
+            ]
+        }
+        return {
+            'id': payment.id,
+            'account_id': payment.account_id,
+            'receiver_id': payment.receiver_id,
+            'created_at': payment.created_at,
+            'archived_at': datetime.datetime.utcnow(),
+            'document': zlib.compress(json.dumps(document).encode('utf-8'))
+        }
+
+    def unpack(self):
+        return json.loads(zlib.decompress(self.document).decode('utf-8'))
+
+
+class Idempotency_Keys(BaseModel, db.Model):
+    """
+        Model for the Idempotency-Key of the requests that create something: the response sent for
+        the key, replayed when the client retries. The writes run on their own connection, in their
+        own transactions, apart from the session of the request.
+    """
+    __tablename__ = 'idempotency_keys'
+
+    # The account that sent the key, keys of different accounts never collide
+    account_id = db.Column(UUID(as_uuid=True), db.ForeignKey("account.id"), primary_key=True)
+    # The Idempotency-Key header
+    key = db.Column(db.String(255), primary_key=True)
+    # sha256 of the method, the path and the body of the request
+    fingerprint = db.Column(db.String(64), nullable=False)
+    # The HTTP status and the body of the response, None while the request is running
+    status = db.Column(db.Integer)
+    response = db.Column(db.Text)
+    # The date when the request started, and when the key can be used again
+    created_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_idempotency_keys_expires_at', 'expires_at'),
+    )
+
+    @staticmethod
+    def find(account_id, key):
+        return Idempotency_Keys.query \
+            .filter_by(account_id=account_id, key=key) \
+            .filter(Idempotency_Keys.expires_at > datetime.datetime.utcnow()) \
+            .first()
+
+    @staticmethod
+    def claim(account_id, key, fingerprint, ttl, claim_timeout):
+        """
+            Records that a request with the key started. An expired key, or one whose request did not
+            finish in claim_timeout seconds (its worker died), is taken over.
+            :return: True when this request got the key, False when another request has it
+        """
+        table = Idempotency_Keys.__table__
+        now = datetime.datetime.utcnow()
+        statement = pg_insert(table).values(
+            account_id=account_id,
+            key=key,
+            fingerprint=fingerprint,
+            created_at=now,
+            expires_at=now + datetime.timedelta(seconds=ttl))
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.account_id, table.c.key],
+            set_={
+                'fingerprint': statement.excluded.fingerprint,
+                'status': None,
+                'response': None,
+                'created_at': statement.excluded.created_at,
+                'expires_at': statement.excluded.expires_at
+            },
+            where=db.or_(
+                table.c.expires_at <= now,
+                db.and_(table.c.status.is_(None), table.c.created_at < now - datetime.timedelta(seconds=claim_timeout))))
+
+        with db.engine.begin() as connection:
+            return connection.execute(statement.returning(table.c.key)).first() is not None
+
+    @staticmethod
+    def complete(account_id, key, status, response):
+        table = Idempotency_Keys.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                table.update()
+                .where(db.and_(table.c.account_id == account_id, table.c.key == key))
+                .values(status=status, response=response))
+
+    @staticmethod
+    def release(account_id, key):
+        """
+            Forgets a key whose request failed, so the client can retry it
+        """
+        table = Idempotency_Keys.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                table.delete()
+                .where(db.and_(table.c.account_id == account_id, table.c.key == key, table.c.status.is_(None))))
@@ -0,0 +1,42 @@
+# server/money.py
+
+from decimal import Decimal, InvalidOperation
+
+
+def exponent(currency):
+    """
+        Number of digits of the minor unit of a currency, as defined by ISO 4217 (EUR 2, JPY 0, BHD 3).
+        The few codes without minor unit (gold, testing codes) count as 0.
+    """
+    return currency.exponent or 0
+
+
+def to_minor_units(amount, currency):
+    """
+        Converts an amount in major units, a number or its string, to an integer of minor units.
+        The number goes through its decimal string, so 0.1 EUR is exactly 10 cents.
+
+        :raise ValueError: when the amount is not a number or is more precise than the currency
+    """
+    if isinstance(amount, bool):
+        raise ValueError('The amount is not valid')
+
+    try:
+        value = Decimal(str(amount))
+    except InvalidOperation:
+        raise ValueError('The amount is not valid')
+
+    if not value.is_finite():
+        raise ValueError('The amount is not valid')
+
+    minor = value.scaleb(exponent(currency))
+    if minor != minor.to_integral_value():
+        raise ValueError('The amount has more decimal places than {} allows'.format(currency.name.upper()))
+    return int(minor)
+
+
+def to_major_units(minor, currency):
+    """
+        The amount in major units, as it is shown in the responses
+    """
+    return float(Decimal(int(minor)).scaleb(-exponent(currency)))
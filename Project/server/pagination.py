@@ -0,0 +1,62 @@
+# server/pagination.py
+
+import json
+import uuid
+import base64
+import binascii
+import datetime
+from flask import request
+from server import app, db
+
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(date, row_id):
+    """
+        Opaque cursor of the (date, id) key of the last row of a page
+    """
+    key = json.dumps([date.strftime(CURSOR_DATE_FORMAT), str(row_id)])
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+        The (date, id) key of a cursor made by encode_cursor
+        :raise ValueError: when the cursor was not made by encode_cursor
+    """
+    try:
+        date, row_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+        return datetime.datetime.strptime(date, CURSOR_DATE_FORMAT), uuid.UUID(row_id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError('The cursor is not valid')
+
+
+def page_arguments():
+    """
+        The limit and the key after which the page starts, from ?limit= and ?cursor=
+        :raise ValueError: when one of them is not valid
+    """
+    limit = request.args.get('limit', app.config['PAGE_SIZE_DEFAULT'])
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError('The limit must be an integer')
+    if not 1 <= limit <= app.config['PAGE_SIZE_MAX']:
+        raise ValueError('The limit must be between 1 and {}'.format(app.config['PAGE_SIZE_MAX']))
+
+    cursor = request.args.get('cursor')
+    return limit, decode_cursor(cursor) if cursor else None
+
+
+def keyset(query, date, row_id, after, limit, descending=False):
+    """
+        The query ordered by (date, id) from the key after, with one row more than the limit to know
+        if there is another page. The WHERE on the key lets postgres start the index scan at the key,
+        so every page costs the same however deep it is.
+    """
+    key = db.tuple_(date, row_id)
+    if after is not None:
+        query = query.filter(key < db.tuple_(*after) if descending else key > db.tuple_(*after))
+
+    order = [date.desc(), row_id.desc()] if descending else [date, row_id]
+    return query.order_by(*order).limit(limit + 1)
@@ -1,7 +1,12 @@
-from flask import request, Blueprint, render_template
+from flask import request, Blueprint, render_template, current_app
+from server import db
 from server.auxiliar_functions import Auxiliar, Message
-from server.models import Account, Payment, Transaction, PaymentState, TransactionState
+from server.money import to_minor_units, to_major_units
+from server.models import Account, Payment, Payment_Archive, Transaction, PaymentState, TransactionState, StateConflict
 from server.user_controller import login_required
+from server.routing import read_only, recent_writes
+from server.idempotency import idempotent
+from server.pagination import page_arguments, keyset, encode_cursor
 from flask_cors import cross_origin
 from http import HTTPStatus
 from iso4217 import Currency
@@ -25,7 +30,8 @@ def test_connection():
 
 @payment_controller.route('/payments/', methods=['POST'])
 @login_required
-def create_payment(account_id):
+@idempotent
+def create_payment(account):
     """
         Make a payment
 
@@ -36,78 +42,71 @@ def create_payment(account_id):
     aux = Auxiliar()
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
-
-    if account:
-        try:
-            # Get parameters
-            request_id = request.json.get('request_id')
-            seller_id = uuid.UUID(uuid.UUID(request.json.get('seller_id')).hex) 
-            currency = request.json.get('currency').upper()
-            reference = request.json.get('reference')
-
-            # Check if there is some missing argument
-            if not request_id or not seller_id or not currency or not reference:
-                code = HTTPStatus.BAD_REQUEST
-                response = {
-                    'status': 'fail',
-                    'message': 'Missing arguments.'
-                }
-                return msg.message(code, response)
-
-            # Flag to check if account exists
-            receiver = Account.query.get(seller_id)
-
-            # Validate parameters
-            if not aux.validate_uuid(seller_id) or not receiver:
-                code = HTTPStatus.BAD_REQUEST
-                response = {
-                    'status': 'fail',
-                    'message': 'The number receiver account is wrong or they dont exist.'
-                }
-                return msg.message(code, response)
+    try:
+        # Get parameters
+        request_id = request.json.get('request_id')
+        seller_id = uuid.UUID(uuid.UUID(request.json.get('seller_id')).hex) 
+        currency = request.json.get('currency').upper()
+        reference = request.json.get('reference')
+
+        # Check if there is some missing argument
+        if not request_id or not seller_id or not currency or not reference:
+            code = HTTPStatus.BAD_REQUEST
+            response = {
+                'status': 'fail',
+                'message': 'Missing arguments.'
+            }
+            return msg.message(code, response)
 
-            # Check if the currency is valid
-            if not isinstance(Currency(currency), Currency):
-                code = HTTPStatus.BAD_REQUEST
-                response = {
-                    'status': 'fail',
-                    'message': 'Your currency is wrong. Uses the international standard that defines three-letter "\
-                                "codes as currencies established by the International Organization. (ISO 4217).'
-                }
-                return msg.message(code, response)
+        # Flag to check if account exists
+        receiver = Account.query.get(seller_id)
 
-        except Exception as exc:
-            code = HTTPStatus.INTERNAL_SERVER_ERROR
+        # Validate parameters
+        if not aux.validate_uuid(seller_id) or not receiver:
+            code = HTTPStatus.BAD_REQUEST
             response = {
                 'status': 'fail',
-                'message': str(exc)
+                'message': 'The number receiver account is wrong or they dont exist.'
             }
+            return msg.message(code, response)
 
-        # Save the new payment
-        # Everytime that we create a payment, his state is "pending"
-        payment = Payment(request_id, account.id, seller_id, Currency(currency), reference)
-        payment.save_to_db()
+        # Check if the currency is valid
+        if not isinstance(Currency(currency), Currency):
+            code = HTTPStatus.BAD_REQUEST
+            response = {
+                'status': 'fail',
+                'message': 'Your currency is wrong. Uses the international standard that defines three-letter "\
+                            "codes as currencies established by the International Organization. (ISO 4217).'
+            }
+            return msg.message(code, response)
 
-        response = {
-            'status': 'success',
-            'id': payment.id
-        }
-    else:
+    except Exception as exc:
         code = HTTPStatus.INTERNAL_SERVER_ERROR
         response = {
             'status': 'fail',
-            'message': 'Try Again.'
-        }        
+            'message': str(exc)
+        }
+
+    # Save the new payment
+    # Everytime that we create a payment, his state is "pending"
+    payment = Payment(request_id, account.id, seller_id, Currency(currency), reference)
+    payment.save_to_db()
+
+    response = {
+        'status': 'success',
+        'id': payment.id
+    }
 
     return msg.message(code, response)
 
 # Get payment
 @payment_controller.route('/payments/', methods=['GET'])
 @login_required
-def get_payments(account_id):
+@read_only
+def get_payments(account):
     """
-        Get the payments from an User
+        Get the payments from an User, newest first, one page of ?limit= payments after ?cursor=.
+        The archived ones are included only with ?archived=true
 
         :rtype: dict | bytes    
     """    
@@ -115,117 +114,252 @@ def get_payments(account_id):
     code = HTTPStatus.OK
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
+    try:
+        archived = request.args.get('archived', '').lower() in ('1', 'true')
+        limit, after = page_arguments()
+    except ValueError as excep:
+        code = HTTPStatus.BAD_REQUEST
+        response = {
+            'status': 'fail',
+            'message': str(excep)
+        }
+        return msg.message(code, response)
+
+    try:
+        payments = keyset(Payment.query.filter_by(account_id=account.id),
+                          Payment.created_at, Payment.id, after, limit, descending=True)
+
+        data = []
+        for payment in payments:
+            payment_data = {
+                'id': payment.id,
+                'request': payment.request_id,
+                'seller': payment.receiver_id,
+                'created_at': payment.created_at,
+                'state': payment.state.name,
+                'amount': to_major_units(payment.amount, payment.currency),
+                'currency': payment.currency.name,
+                'reference': payment.reference
+            }
+            data.append(payment_data)
+
+        if archived:
+            archives = keyset(Payment_Archive.query.filter_by(account_id=account.id),
+                              Payment_Archive.created_at, Payment_Archive.id, after, limit, descending=True)
+            for archive in archives:
+                payment = archive.unpack()
+                currency = Currency[payment['currency']]
+                data.append({
+                    'id': archive.id,
+                    'request': payment['request'],
+                    'seller': archive.receiver_id,
+                    'created_at': archive.created_at,
+                    'state': payment['state'],
+                    'amount': to_major_units(payment['amount'], currency),
+                    'currency': currency.name,
+                    'reference': payment['reference'],
+                    'archived': True
+                })
+
+            # both pages are in the same order, the page is the newest of the two
+            data.sort(key=lambda payment: (payment['created_at'], payment['id']), reverse=True)
+
+        # one payment more than the limit was read when there is another page
+        last = data[limit - 1] if len(data) > limit else None
+
+        response = {
+            'status': 'success',
+            'payments': data[:limit],
+            'next_cursor': encode_cursor(last['created_at'], last['id']) if last else None
+        }
+    except Exception as err:
+        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        response = {
+            'status': 'fail',
+            'message': str(err)
+        }
+
+    return msg.message(code, response)
+
+# Create and request transaction
+@payment_controller.route('/payments/<uuid:payment_id>/transactions', methods=['POST'])
+@login_required 
+@idempotent
+def create_transaction(account, payment_id):
+    """
+        Add transaction to payment by ID
+
+        :param account: The authenticated account
+        :type account: Account
+        :param payment_id: Id of the payment to be associated
+        :type payment_id: uuid
+
+        :rtype: dict | bytes (Transaction details)
+    """
+
+    code = HTTPStatus.CREATED
+    msg = Message()
 
-    if account:
+    if account.state:
         try:
-            payments = Payment.query.filter_by(account_id=account.id)
+            amount = request.json.get('amount')
+            reference = request.json.get('reference')
 
-            data = []
-            for payment in payments:
-                payment_data = {
-                    'id': payment.id,
-                    'request': payment.request_id,
-                    'seller': payment.receiver_id,
-                    'created_at': payment.created_at,
-                    'state': payment.state.name,
-                    'amount': payment.amount,
-                    'currency': payment.currency.name,
-                    'reference': payment.reference
+            # Check if missing arguments
+            if not amount or not reference:
+                code = HTTPStatus.BAD_REQUEST
+                response = {
+                    'status': 'fail',
+                    'message': "The amount or reference values is missing"
                 }
-                data.append(payment_data)
+                return msg.message(code, response)
 
+            payment = Payment.query.get(payment_id)
+
+            # Check if payments exists
+            if not payment:
+                code = HTTPStatus.NOT_FOUND
+                response = {
+                    'status': 'fail',
+                    'message': "Payment not found"
+                }
+                return msg.message(code, response)
+
+            # The amount is kept in minor units of the payment currency
+            amount = to_minor_units(amount, payment.currency)
+            if amount <= 0:
+                raise ValueError("The amount needs to be more than 0")
+
+        except ValueError as excep:
+            code = HTTPStatus.BAD_REQUEST
             response = {
-                'status': 'success',
-                'payments': data
+                'status': 'fail',
+                'message': str(excep)
             }
-        except Exception as err:
+            return msg.message(code, response)
+        except Exception as excep:
             code = HTTPStatus.INTERNAL_SERVER_ERROR
             response = {
                 'status': 'fail',
-                'message': str(err)
+                'message': str(excep)
             }
+            return msg.message(code, response)
 
+        # Create a transaction and add it to the payment amount, in the same commit
+        transaction = Transaction(amount, payment_id, reference)
+        db.session.add(transaction)
+        Payment.add_to_amount(payment_id, amount)
+        db.session.commit()
+
+        response = {
+            'status': 'success',
+            'id': transaction.id
+        }                
     else:
-        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        code = HTTPStatus.METHOD_NOT_ALLOWED
         response = {
             'status': 'fail',
-            'message': 'Try Again.'
-        }   
+            'message': 'Your number account is desactivated.'
+        }  
 
     return msg.message(code, response)
 
-# Create and request transaction
-@payment_controller.route('/payments/<uuid:payment_id>/transactions', methods=['POST'])
-@login_required 
-def create_transaction(account_id, payment_id):
+# Create several transactions at once
+@payment_controller.route('/payments/<uuid:payment_id>/transactions/batch', methods=['POST'])
+@login_required
+@idempotent
+def create_transactions(account, payment_id):
     """
-        Add transaction to payment by ID
+        Add several transactions to a payment by ID, in one INSERT and one commit
 
-        :param account_id: Account id
-        :type account_id: uuid
+        :param account: The authenticated account
+        :type account: Account
         :param payment_id: Id of the payment to be associated
         :type payment_id: uuid
 
-        :rtype: dict | bytes (Transaction details)
+        :rtype: dict | bytes (the ids of the transactions, in the order they were sent)
     """
 
     code = HTTPStatus.CREATED
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
+    if account.state:
+        try:
+            transactions = request.json
 
-    if account:
-        
-        if account.state:
-            try:
-                amount = request.json.get('amount')
-                reference = request.json.get('reference')
+            # Check the list of transactions
+            if not isinstance(transactions, list) or not transactions:
+                code = HTTPStatus.BAD_REQUEST
+                response = {
+                    'status': 'fail',
+                    'message': "Send a list of transactions, each one with amount and reference"
+                }
+                return msg.message(code, response)
 
-                # Check if missing arguments
-                if not amount or not reference:
-                    code = HTTPStatus.BAD_REQUEST
-                    response = {
-                        'status': 'fail',
-                        'message': "The amount or reference values is missing"
-                    }
-                    return msg.message(code, response)
+            if len(transactions) > current_app.config['TRANSACTION_BATCH_LIMIT']:
+                code = HTTPStatus.BAD_REQUEST
+                response = {
+                    'status': 'fail',
+                    'message': "At most {} transactions can be sent at once".format(
+                        current_app.config['TRANSACTION_BATCH_LIMIT'])
+                }
+                return msg.message(code, response)
 
-                payment = Payment.query.get(payment_id)
+            payment = Payment.query.get(payment_id)
 
-                # Check if payments exists
-                if not payment:
-                    code = HTTPStatus.NOT_FOUND
-                    response = {
-                        'status': 'fail',
-                        'message': "Payment not found"
-                    }
-                    return msg.message(code, response)
+            # Check if payments exists
+            if not payment:
+                code = HTTPStatus.NOT_FOUND
+                response = {
+                    'status': 'fail',
+                    'message': "Payment not found"
+                }
+                return msg.message(code, response)
 
-            except Exception as excep:
-                return msg.message(code, str(excep))
+            legs = []
+            for transaction in transactions:
+                amount = transaction.get('amount') if isinstance(transaction, dict) else None
+                reference = transaction.get('reference') if isinstance(transaction, dict) else None
 
-            # Create a transaction
-            transaction = Transaction(amount, payment_id, reference)
-            transaction.save_to_db()
+                # Check if missing arguments
+                if not amount or not reference:
+                    raise ValueError("The amount or reference values is missing")
 
-            payment.amount += amount
+                # The amount is kept in minor units of the payment currency
+                amount = to_minor_units(amount, payment.currency)
+                if amount <= 0:
+                    raise ValueError("The amount needs to be more than 0")
+                legs.append((amount, reference))
 
+        except ValueError as excep:
+            code = HTTPStatus.BAD_REQUEST
             response = {
-                'status': 'success',
-                'id': transaction.id
-            }                
-        else:
-            code = HTTPStatus.METHOD_NOT_ALLOWED
+                'status': 'fail',
+                'message': str(excep)
+            }
+            return msg.message(code, response)
+        except Exception as excep:
+            code = HTTPStatus.INTERNAL_SERVER_ERROR
             response = {
                 'status': 'fail',
-                'message': 'Your number account is desactivated.'
-            }  
+                'message': str(excep)
+            }
+            return msg.message(code, response)
+
+        # Create the transactions and add them to the payment amount, in the same commit
+        ids = Transaction.create_many(payment_id, legs)
+        Payment.add_to_amount(payment_id, sum(amount for amount, _ in legs))
+        db.session.commit()
+
+        response = {
+            'status': 'success',
+            'ids': ids
+        }
     else:
-        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        code = HTTPStatus.METHOD_NOT_ALLOWED
         response = {
             'status': 'fail',
-            'message': 'Try Again.'
+            'message': 'Your number account is desactivated.'
         }
 
     return msg.message(code, response)
@@ -233,12 +367,12 @@ def create_transaction(account_id, payment_id):
 # Cancel a transaction
 @payment_controller.route('/payments/<uuid:payment_id>/transactions/<uuid:transaction>/cancel', methods=['POST'])
 @login_required
-def cancel_transaction(account_id, payment_id, transaction):
+def cancel_transaction(account, payment_id, transaction):
     """
         Cancel transaction from payment by the ID of the transaction
 
-        :param account_id: Account id
-        :type account_id: uuid
+        :param account: The authenticated account
+        :type account: Account
         :param payment_id: Id of the payment
         :type payment_id: uuid
         :param transaction: Id of the transaction
@@ -251,71 +385,60 @@ def cancel_transaction(account_id, payment_id, transaction):
     msg = Message()
 
     try:
-        account = Account.query.filter_by(id=account_id).first()
-
-        if account:
-            if account.state:
-                try:
-
-                    payment = Payment.query.get(payment_id)
-
-                    # Check if payments exists
-                    if not payment:
-                        code = HTTPStatus.NOT_FOUND
-                        response = {
-                            'status': 'fail',
-                            'message': "Payment not found"
-                        }
-                        return msg.message(code, response)
-
-                    transaction = Transaction.query.get(transaction)
-
-                    # Check if transaction exists
-                    if not transaction:
-                        code = HTTPStatus.NOT_FOUND
-                        response = {
-                            'status': 'fail',
-                            'message': "Transaction not found"
-                        }
-                        return msg.message(code, response)
-
-                    if transaction.state == PaymentState("completed"):
-                        code = HTTPStatus.CONFLICT
-                        response = {
-                            'status': 'fail',
-                            'message': "The transaction is already completed, you cannot cancel"
-                        }
-                        return msg.message(code, response)
-
-                    # Calculate the amount that will no longer be included in the final payment
-                    diff = payment.amount - transaction.amount
-
-                    payment.amount -= diff
-
-                    # The transaction was cancelled
-                    transaction.state = PaymentState("cancelled")
+        if account.state:
+            try:
 
+                # The payment is locked before the transaction, in the order execute and the settlement
+                # lock them, so a cancel running next to them can not deadlock
+                payment = Payment.query.filter_by(id=payment_id).with_for_update().first()
+
+                # Check if payments exists
+                if not payment:
+                    code = HTTPStatus.NOT_FOUND
                     response = {
-                        'status': 'success',
-                        'message': 'The transaction '+str(transaction.id)+' was cancelled'
+                        'status': 'fail',
+                        'message': "Payment not found"
                     }
+                    return msg.message(code, response)
+
+                # The transaction is cancelled only if it was not completed or cancelled yet
+                amount = Transaction.transition_one(payment_id, transaction, TransactionState.cancelled)
+
+                # The amount of the transaction will no longer be included in the final payment
+                Payment.add_to_amount(payment.id, -amount)
+                db.session.commit()
+
+                response = {
+                    'status': 'success',
+                    'message': 'The transaction '+str(transaction)+' was cancelled'
+                }
 
-                except Exception as exc:
+            except StateConflict as conflict:
+                db.session.rollback()
+
+                # Check if transaction exists
+                if conflict.current is None:
+                    code = HTTPStatus.NOT_FOUND
                     response = {
                         'status': 'fail',
-                        'message': str(exc)
+                        'message': "Transaction not found"
                     }
-            else:
-                code = HTTPStatus.METHOD_NOT_ALLOWED
+                else:
+                    code = HTTPStatus.CONFLICT
+                    response = {
+                        'status': 'fail',
+                        'message': "The transaction is already " + conflict.current.name + ", you cannot cancel"
+                    }
+            except Exception as exc:
                 response = {
                     'status': 'fail',
-                    'message': 'Your number account is desactivated.'
+                    'message': str(exc)
                 }
         else:
-            code = HTTPStatus.INTERNAL_SERVER_ERROR
+            code = HTTPStatus.METHOD_NOT_ALLOWED
             response = {
                 'status': 'fail',
-                'message': 'Try Again.'
+                'message': 'Your number account is desactivated.'
             }
     except Exception as err:
         code = HTTPStatus.INTERNAL_SERVER_ERROR
@@ -328,12 +451,12 @@ def cancel_transaction(account_id, payment_id, transaction):
 # Execute the payment
 @payment_controller.route('/payments/<uuid:payment_id>/execute', methods=['GET', 'POST'])
 @login_required
-def execute(account_id, payment_id):
+def execute(account, payment_id):
     """
         Execute payment by ID
 
-        :param account_id: Account id
-        :type account_id: uuid
+        :param account: The authenticated account
+        :type account: Account
         :param payment_id: Id of the payment to be executed
         :type payment_id: uuid
 
@@ -343,92 +466,64 @@ def execute(account_id, payment_id):
     code = HTTPStatus.OK
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
-
-    if account:
-
-        if account.state:
-            try:
-
-                payment = Payment.query.get(payment_id)
-
-                # Check if payments exists
-                if not payment:
-                    code = HTTPStatus.NOT_FOUND
-                    response = {
-                        'status': 'fail',
-                        'message': "Payment not found"
-                    }
-                    return msg.message(code, response)
-
-                if payment.state == PaymentState("completed"):
-                    code = HTTPStatus.CONFLICT
-                    response = {
-                        'status': 'fail',
-                        'message': "The payment is already completed"
-                    }
-                    return msg.message(code, response)
-
-                if payment.state == PaymentState("authorized"):
-
-                    transactions = Transaction.query.filter_by(id_payment=payment_id, state="created")
-
-                    total = 0.0
-
-                    for t in transactions:
-                        t.state = "completed"
-                        total += t.amount
+    if account.state:
+        try:
+            # The payment of this buyer is completed only if it is still authorized, in one statement
+            # that also locks it, so a concurrent execute of the same payment gets a conflict
+            _, receiver_id, _ = Payment.transition(payment_id, PaymentState.completed, account.id)
 
-                    try:
+            # One UPDATE completes the authorized transactions and returns their amounts
+            legs = Transaction.transition(payment_id, TransactionState.authorized, TransactionState.completed)
 
-                        # Check if he is enough money to pay
-                        if total > account.balance:
-                            code = HTTPStatus.NOT_ACCEPTABLE
-                            response = {
-                                'status': 'fail',
-                                'message': "The account does not have enough available amount"
-                            }
-                            return msg.message(code, response)
+            # Check if he is enough money to pay, while his account is locked
+            if not Account.transfer(account.id, receiver_id, legs, payment_id):
+                db.session.rollback()
+                code = HTTPStatus.NOT_ACCEPTABLE
+                response = {
+                    'status': 'fail',
+                    'message': "The account does not have enough available amount"
+                }
+                return msg.message(code, response)
 
-                        seller = Account.query.get(payment.receiver_id)
-                        seller.balance += total
+            db.session.commit()
 
-                        account.balance -= total
-                        payment.state = PaymentState("completed")
+            response = {
+                'status': 'success',
+                'message': 'The payment was executed'
+            }
+        except StateConflict as conflict:
+            db.session.rollback()
 
-                        response = {
-                            'status': 'success',
-                            'message': 'The payment was executed'
-                        }
-                    except Exception as exc:
-                        code = HTTPStatus.INTERNAL_SERVER_ERROR
-                        response = {
-                            'status': 'fail',
-                            'message': str(exc)
-                        }
-                else:
-                    code = HTTPStatus.METHOD_NOT_ALLOWED
-                    response = {
-                        'status': 'fail',
-                        'message': 'Payment not authorized.'
-                    }
-            except Exception as exc:
-                code = HTTPStatus.INTERNAL_SERVER_ERROR
+            # Check if payments exists
+            if conflict.current is None:
+                code = HTTPStatus.NOT_FOUND
                 response = {
                     'status': 'fail',
-                    'message': str(exc)
+                    'message': "Payment not found"
                 }
-        else:
-            code = HTTPStatus.METHOD_NOT_ALLOWED
+            elif conflict.current == PaymentState.completed:
+                code = HTTPStatus.CONFLICT
+                response = {
+                    'status': 'fail',
+                    'message': "The payment is already completed"
+                }
+            else:
+                code = HTTPStatus.METHOD_NOT_ALLOWED
+                response = {
+                    'status': 'fail',
+                    'message': 'Payment not authorized.'
+                }
+        except Exception as exc:
+            code = HTTPStatus.INTERNAL_SERVER_ERROR
             response = {
                 'status': 'fail',
-                'message': 'Your number account is desactivated.'
+                'message': str(exc)
             }
     else:
-        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        code = HTTPStatus.METHOD_NOT_ALLOWED
         response = {
             'status': 'fail',
-            'message': 'Try Again.'
+            'message': 'Your number account is desactivated.'
         }
 
     return msg.message(code, response)
@@ -437,12 +532,12 @@ def execute(account_id, payment_id):
 # Authorize the payment
 @payment_controller.route('/payments/<uuid:payment_id>/authorize', methods=['POST'])
 @login_required
-def authorization_payment(account_id, payment_id):
+def authorization_payment(account, payment_id):
     """
         Authorization the payment
 
-        :param account_id: Account id
-        :type : uuid
+        :param account: The authenticated account
+        :type account: Account
         :param payment_id: Id of the payment
         :type payment_id: int
 
@@ -452,59 +547,50 @@ def authorization_payment(account_id, payment_id):
     code = HTTPStatus.OK
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
-
-    if account:
-
-        if account.state:
-            try:
-                payment = Payment.query.get(payment_id)
-
-                # Check if payments exists
-                if not payment:
-                    code = HTTPStatus.NOT_FOUND
-                    response = {
-                        'status': 'fail',
-                        'message': "Payment not found"
-                    }
-                    return msg.message(code, response)
-
-                if payment.state == PaymentState("completed"):
-                    code = HTTPStatus.CONFLICT
-                    response = {
-                        'status': 'fail',
-                        'message': "The payment is already completed"
-                    }
-                    return msg.message(code, response)
-
-                if payment.state == PaymentState("pending"):
-                    payment.update_state("requested")
-
+    if account.state:
+        try:
+            # Only a pending payment is moved, one already requested or authorized is left as it is
+            Payment.transition(payment_id, PaymentState.requested)
+            db.session.commit()
+        except StateConflict as conflict:
+            db.session.rollback()
+
+            # Check if payments exists
+            if conflict.current is None:
+                code = HTTPStatus.NOT_FOUND
                 response = {
-                    'status': 'success',
-                    'payment': payment_id,
-                    'message': 'http://192.168.85.208/payments/'+str(payment_id)+'/authorize/request'
+                    'status': 'fail',
+                    'message': "Payment not found"
                 }
+                return msg.message(code, response)
 
-            except Exception as exc:
-                code = HTTPStatus.INTERNAL_SERVER_ERROR
+            if conflict.current in (PaymentState.completed, PaymentState.cancelled):
+                code = HTTPStatus.CONFLICT
                 response = {
                     'status': 'fail',
-                    'message': str(exc)
+                    'message': "The payment is already " + conflict.current.name
                 }
-
-        else:
-            code = HTTPStatus.METHOD_NOT_ALLOWED
+                return msg.message(code, response)
+        except Exception as exc:
+            code = HTTPStatus.INTERNAL_SERVER_ERROR
             response = {
                 'status': 'fail',
-                'message': 'Your number account is desactivated.'
-            }  
+                'message': str(exc)
+            }
+            return msg.message(code, response)
+
+        response = {
+            'status': 'success',
+            'payment': payment_id,
+            'message': 'http://192.168.85.208/payments/'+str(payment_id)+'/authorize/request'
+        }
+
     else:
-        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        code = HTTPStatus.METHOD_NOT_ALLOWED
         response = {
             'status': 'fail',
-            'message': 'Try Again.'
-        }
+            'message': 'Your number account is desactivated.'
+        }  
 
     return msg.message(code, response)
 
@@ -528,7 +614,7 @@ def authorize(payment_id):
             'seller': str(account_seller.id),
             'created_at': payment.created_at,
             'state': payment.state.name,
-            'amount': payment.amount,
+            'amount': to_major_units(payment.amount, payment.currency),
             'currency': payment.currency.name,
             'reference': payment.reference
         }
@@ -538,7 +624,7 @@ def authorize(payment_id):
         data = []
         for transaction in transactions:
             transaction_data = {
-                'amount': transaction.amount,
+                'amount': to_major_units(transaction.amount, payment.currency),
                 'emission_date': transaction.emission_date.date(),
                 'emission_time': transaction.emission_date.strftime("%H:%M:%S"),
                 'state': transaction.state.name,
@@ -573,28 +659,27 @@ def authorize_response(payment_id):
 
     try:
 
-        payment = Payment.query.get(payment_id)
+        # The payment and all its transactions are authorized in one commit, if it was requested
+        payer_id, receiver_id, _ = Payment.transition(payment_id, PaymentState.authorized)
+        Transaction.transition(payment_id, TransactionState.created, TransactionState.authorized)
+        db.session.commit()
 
-        if payment.state != PaymentState("requested"):
-            code = HTTPStatus.METHOD_NOT_ALLOWED
-            response = {
-                'status': 'fail',
-                'message': 'You dont have any authorization request.'
-            }
-            return msg.message(code, response)
-
-        payment.update_state("authorized")
-
-        transactions = Transaction.query.filter_by(id_payment=payment_id)
-
-        for t in transactions:
-            t.update_state("authorized")
+        # nobody is logged in here, the next reads of both parties must still see the new state
+        recent_writes.mark(payer_id)
+        recent_writes.mark(receiver_id)
 
         response = {
             'status': 'success',
             'message': 'Your payment was authorized.'
         }
 
+    except StateConflict as conflict:
+        db.session.rollback()
+        code = HTTPStatus.NOT_FOUND if conflict.current is None else HTTPStatus.CONFLICT
+        response = {
+            'status': 'fail',
+            'message': 'Payment not found' if conflict.current is None else 'You dont have any authorization request.'
+        }
     except Exception as exc:
         code = HTTPStatus.INTERNAL_SERVER_ERROR
         response = {
@@ -606,12 +691,14 @@ def authorize_response(payment_id):
 # Get all the transactions
 @payment_controller.route('/payments/<uuid:payment_id>/transactions', methods=['GET'])
 @login_required
-def get_transactions(account_id, payment_id):
+@read_only
+def get_transactions(account, payment_id):
     """
-        Find transactions from payment by ID
+        Find transactions from payment by ID, in the order they were emitted,
+        one page of ?limit= transactions after ?cursor=
 
-        :param account_id: Account_id
-        :type account_id: uuid
+        :param account: The authenticated account
+        :type account: Account
         :param payment_id: Id of the payment associated
         :type payment_id: uuid
 
@@ -621,58 +708,64 @@ def get_transactions(account_id, payment_id):
     code = HTTPStatus.OK
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
-
-    if account:
-        
-        if account.state:
-            try:
-                payment = Payment.query.get(payment_id)
-
-                # Check if payments exists
-                if not payment:
-                    code = HTTPStatus.NOT_FOUND
-                    response = {
-                        'status': 'fail',
-                        'message': "Payment not found"
-                    }
+    if account.state:
+        try:
+            limit, after = page_arguments()
+        except ValueError as excep:
+            code = HTTPStatus.BAD_REQUEST
+            response = {
+                'status': 'fail',
+                'message': str(excep)
+            }
+            return msg.message(code, response)
 
-                transactions = Transaction.query.filter_by(id_payment=payment_id)
-
-                data = []
-                for transaction in transactions:
-                    transaction_data = {
-                        'id': transaction.id,
-                        'amount': transaction.amount,
-                        'emission_date': transaction.emission_date,
-                        'state': transaction.state.name,
-                        'update_date': transaction.update_date,
-                        'id_payment': transaction.id_payment,
-                        'reference': transaction.reference
-                    }
-                    data.append(transaction_data)
+        try:
+            payment = Payment.query.get(payment_id)
 
-                response = {
-                    'status': 'success',
-                    'transactions': data
-                }
-            except Exception as excep:
-                code = HTTPStatus.INTERNAL_SERVER_ERROR
+            # Check if payments exists
+            if not payment:
+                code = HTTPStatus.NOT_FOUND
                 response = {
                     'status': 'fail',
-                    'message': str(excep)
+                    'message': "Payment not found"
                 }
-        else:
-            code = HTTPStatus.METHOD_NOT_ALLOWED
+                return msg.message(code, response)
+
+            transactions = keyset(Transaction.query.filter_by(id_payment=payment_id),
+                                  Transaction.emission_date, Transaction.id, after, limit).all()
+
+            data = []
+            for transaction in transactions[:limit]:
+                transaction_data = {
+                    'id': transaction.id,
+                    'amount': to_major_units(transaction.amount, payment.currency),
+                    'emission_date': transaction.emission_date,
+                    'state': transaction.state.name,
+                    'update_date': transaction.update_date,
+                    'id_payment': transaction.id_payment,
+                    'reference': transaction.reference
+                }
+                data.append(transaction_data)
+
+            # one transaction more than the limit was read when there is another page
+            last = transactions[limit - 1] if len(transactions) > limit else None
+
+            response = {
+                'status': 'success',
+                'transactions': data,
+                'next_cursor': encode_cursor(last.emission_date, last.id) if last else None
+            }
+        except Exception as excep:
+            code = HTTPStatus.INTERNAL_SERVER_ERROR
             response = {
                 'status': 'fail',
-                'message': 'Your number account is desactivated.'
+                'message': str(excep)
             }
     else:
-        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        code = HTTPStatus.METHOD_NOT_ALLOWED
         response = {
             'status': 'fail',
-            'message': 'Try Again.'
+            'message': 'Your number account is desactivated.'
         }
 
     return msg.message(code, response)
@@ -680,12 +773,13 @@ def get_transactions(account_id, payment_id):
 # Get a specific transaction
 @payment_controller.route('/payments/<uuid:payment_id>/transactions/<uuid:transaction>', methods=['GET'])
 @login_required
-def get_transaction(account_id, payment_id, transaction):
+@read_only
+def get_transaction(account, payment_id, transaction):
     """
         Find transactions from payment by ID
 
-        :param account_id: Account id
-        :type account_id: uuid
+        :param account: The authenticated account
+        :type account: Account
         :param payment_id: Id of the payment associated
         :type payment_id: uuid
         :param transaction: A specific transaction of a payment
@@ -697,53 +791,43 @@ def get_transaction(account_id, payment_id, transaction):
     code = HTTPStatus.OK
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
-
-    if account:
-        
-        if account.state:
-            try:
-                payment = Payment.query.get(payment_id)
-
-                # Check if payments exists
-                if not payment:
-                    code = HTTPStatus.NOT_FOUND
-                    response = {
-                        'status': 'fail',
-                        'message': "Payment not found"
-                    }
-                    return msg.message(code, response)
-
-                transaction = Transaction.query.get(transaction)
+    if account.state:
+        try:
+            payment = Payment.query.get(payment_id)
 
-                response = {
-                    'status': 'success',
-                    'transaction':
-                    {
-                        'id': transaction.id,
-                        'amount': transaction.amount,
-                        'emission_date': transaction.emission_date,
-                        'state': transaction.state.name,
-                        'update_date': transaction.update_date,
-                        'id_payment': transaction.id_payment
-                    }
-                }
-            except Exception as excep:
-                code = HTTPStatus.INTERNAL_SERVER_ERROR
+            # Check if payments exists
+            if not payment:
+                code = HTTPStatus.NOT_FOUND
                 response = {
                     'status': 'fail',
-                    'message': str(excep)
+                    'message': "Payment not found"
                 }
-        else:
-            code = HTTPStatus.METHOD_NOT_ALLOWED
+                return msg.message(code, response)
+
+            transaction = Transaction.find_in_payment(payment_id, transaction)
+
+            response = {
+                'status': 'success',
+                'transaction':
+                {
+                    'id': transaction.id,
+                    'amount': to_major_units(transaction.amount, payment.currency),
+                    'emission_date': transaction.emission_date,
+                    'state': transaction.state.name,
+                    'update_date': transaction.update_date,
+                    'id_payment': transaction.id_payment
+                }
+            }
+        except Exception as excep:
+            code = HTTPStatus.INTERNAL_SERVER_ERROR
             response = {
                 'status': 'fail',
-                'message': 'Your number account is desactivated.'
-            }  
+                'message': str(excep)
+            }
     else:
-        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        code = HTTPStatus.METHOD_NOT_ALLOWED
         response = {
             'status': 'fail',
-            'message': 'Try Again.'
-        }
+            'message': 'Your number account is desactivated.'
+        }  
     return msg.message(code, response)
@@ -0,0 +1,60 @@
+# server/pool.py
+
+import time
+import threading
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+        QueuePool that measures how long the checkouts wait for a connection.
+        Each worker has its own pool (it is recreated after the fork), so the numbers
+        are the ones of the worker that serves /stats.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeout:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return connection
+
+    def stats(self):
+        capacity = self.size() + max(self._max_overflow, 0)
+        with self._stats_lock:
+            return {
+                'size': self.size(),
+                'max_overflow': self._max_overflow,
+                'checked_out': self.checkedout(),
+                'saturation': round(self.checkedout() / capacity, 4) if capacity else 0.0,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_avg_ms': round(self.wait_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 3)
+            }
+
+
+def lift_statement_timeout(session):
+    """
+        Lets the statements of the current database transaction run past DB_STATEMENT_TIMEOUT, for the
+        maintenance jobs. SET LOCAL ends with the transaction, the pooled connection keeps the limit.
+    """
+    session.execute('SET LOCAL statement_timeout = 0')
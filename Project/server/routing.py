@@ -0,0 +1,71 @@
+# server/routing.py
+
+import time
+from functools import wraps
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+from server.shared_table import SharedHashTable, shared_path
+
+
+class RoutingSession(SignallingSession):
+    """
+        Session that sends the queries of the read-only endpoints to the replica (the 'replica'
+        bind), when one is configured. Everything else, and any flush, goes to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and g.get('read_replica') and not self._flushing:
+            return self.db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class RecentWrites:
+    """
+        Accounts that changed something in the last REPLICA_STICKY_SECONDS, in a table shared by
+        the workers of the node. Their reads stay on the primary until the replica caught up,
+        so an account always reads its own writes.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.window = 0
+        self.table = None
+
+    def init_app(self, app):
+        self.enabled = 'replica' in (app.config.get('SQLALCHEMY_BINDS') or {})
+        self.window = app.config['REPLICA_STICKY_SECONDS']
+        path = app.config['REPLICA_WRITES_PATH'] or shared_path('payment_writes')
+        self.table = SharedHashTable(path, app.config['REPLICA_WRITES_SLOTS'])
+
+    def mark(self, account_id):
+        if self.enabled and self.window > 0:
+            self.table.set(str(account_id), time.time() + self.window)
+
+    def __contains__(self, account_id):
+        return self.enabled and str(account_id) in self.table
+
+
+recent_writes = RecentWrites()
+
+
+def read_only(f):
+    """
+        Serves the endpoint from the replica, unless the authenticated account wrote recently
+    """
+    @wraps(f)
+    def decorated_function(*args, **kws):
+        account_id = g.get('account_id')
+        g.read_replica = recent_writes.enabled and (account_id is None or account_id not in recent_writes)
+        try:
+            return f(*args, **kws)
+        finally:
+            g.read_replica = False
+
+    decorated_function.read_only = True
+    return decorated_function
@@ -0,0 +1,120 @@
+# server/session_store.py
+
+import time
+import hashlib
+from server.shared_table import SharedHashTable, shared_path
+
+
+def token_digest(token):
+    """
+        SHA-256 of the raw JWT, whatever way it was handed over (bytes, str or the str() of the bytes).
+        Sessions are stored and looked up by this fixed size digest, never by the token itself.
+    """
+    if isinstance(token, bytes):
+        token = token.decode()
+    if token.startswith("b'") and token.endswith("'"):
+        token = token[2:-1]
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+class SessionStore:
+    """
+        Where the active sessions are kept. The backend is chosen with SESSION_STORE.
+        Changes are part of the current database transaction, the caller commits them
+        and then calls discard, so no copy of a removed session outlives the commit.
+    """
+
+    def add(self, token_hash, refresh_hash, user_id):
+        raise NotImplementedError
+
+    def contains_locally(self, token_hash):
+        """
+            True when the session is known without asking the database
+        """
+        return False
+
+    def remember(self, token_hash):
+        """
+            Keeps a session the caller found in the database for the next lookups
+            :return: True when the session is now known without asking the database
+        """
+        return False
+
+    def remove(self, token_hash):
+        raise NotImplementedError
+
+    def discard(self, token_hash):
+        pass
+
+    def stats(self):
+        return {'backend': self.__class__.__name__}
+
+
+class DatabaseSessionStore(SessionStore):
+    """
+        The active_sessions table, the durable copy of the sessions
+    """
+
+    def __init__(self, db, model):
+        self.db = db
+        self.model = model
+
+    def add(self, token_hash, refresh_hash, user_id):
+        self.db.session.add(self.model(token_hash=token_hash, refresh_hash=refresh_hash, user_id=user_id))
+
+    def remove(self, token_hash):
+        self.model.query.filter(self.model.token_hash == token_hash).delete()
+
+
+class SharedMemorySessionStore(SessionStore):
+    """
+        Sessions of the node in a shared memory hash table, in front of the database.
+        A token missing from the table is looked up in the database and copied into it,
+        so the table can be lost or full without losing any session.
+    """
+
+    def __init__(self, table, fallback, ttl):
+        self.table = table
+        self.fallback = fallback
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, token_hash, refresh_hash, user_id):
+        self.fallback.add(token_hash, refresh_hash, user_id)
+        self.table.set(token_hash, time.time() + self.ttl)
+
+    def contains_locally(self, token_hash):
+        if token_hash in self.table:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def remember(self, token_hash):
+        return self.table.set(token_hash, time.time() + self.ttl)
+
+    def remove(self, token_hash):
+        self.fallback.remove(token_hash)
+
+    def discard(self, token_hash):
+        self.table.delete(token_hash)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(self.table.usage(), hits=self.hits, misses=self.misses)
+        return stats
+
+
+def create_session_store(app, db, model):
+    database = DatabaseSessionStore(db, model)
+
+    if app.config['SESSION_STORE'] == 'database':
+        return database
+
+    if app.config['SESSION_STORE'] == 'shared_memory':
+        path = app.config['SESSION_STORE_PATH'] or shared_path('payment_sessions')
+        table = SharedHashTable(path, app.config['SESSION_STORE_SLOTS'])
+        return SharedMemorySessionStore(table, database, app.config['AUTH_TOKEN_LIFETIME'])
+
+    raise ValueError('Unknown session store {}'.format(app.config['SESSION_STORE']))
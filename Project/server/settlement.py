@@ -0,0 +1,187 @@
+# server/settlement.py
+
+import time
+import queue
+import datetime
+import multiprocessing
+import click
+from server import app, db
+from server.pool import lift_statement_timeout
+from server.models import Account, EntryKind, Ledger_Entries, Payment, PaymentState, Transaction, TransactionState
+
+
+def claim_payments(cutoff, after, chunk_size):
+    """
+        The next chunk_size authorized payments created up to cutoff, in (created_at, id) order after
+        the key after, locked until the end of the database transaction. The payments locked by an
+        execute or by another settlement process are skipped instead of waited for.
+    """
+    query = db.session.query(Payment.id, Payment.account_id, Payment.receiver_id, Payment.created_at) \
+        .filter(Payment.state == PaymentState.authorized, Payment.created_at <= cutoff)
+    if after is not None:
+        query = query.filter(db.tuple_(Payment.created_at, Payment.id) > db.tuple_(*after))
+
+    return query.order_by(Payment.created_at, Payment.id) \
+        .limit(chunk_size) \
+        .with_for_update(skip_locked=True) \
+        .all()
+
+
+def settle_chunk(cutoff, after, chunk_size):
+    """
+        Executes one chunk of authorized payments in one database transaction. The payers are locked
+        in the order of their ids, so two processes never wait for each other's accounts, and their
+        balances are read with one query. The payments are paid oldest first while the balance of the
+        payer allows it; the others stay authorized.
+
+        :return: None when there are no payments left, or the key of the last payment claimed and the counts
+    """
+    lift_statement_timeout(db.session)
+    payments = claim_payments(cutoff, after, chunk_size)
+    if not payments:
+        db.session.commit()
+        return None
+
+    ids = [payment.id for payment in payments]
+    payers = sorted({payment.account_id for payment in payments})
+    db.session.query(Account.id).filter(Account.id.in_(payers)).order_by(Account.id).with_for_update().all()
+    balances = Ledger_Entries.balances(payers)
+
+    legs = {}
+    authorized = db.session.query(Transaction.id_payment, Transaction.id, Transaction.amount) \
+        .filter(Transaction.id_payment.in_(ids), Transaction.state == TransactionState.authorized)
+    for payment_id, transaction_id, amount in authorized:
+        legs.setdefault(payment_id, []).append((transaction_id, amount))
+
+    settled = []
+    entries = []
+    for payment in payments:
+        total = sum(amount for _, amount in legs.get(payment.id, []))
+        if balances[payment.account_id] < total:
+            continue
+
+        balances[payment.account_id] -= total
+        settled.append(payment.id)
+        for transaction_id, amount in legs.get(payment.id, []):
+            entries.append(Ledger_Entries.entry(payment.account_id, -amount, EntryKind.payment, payment.id, transaction_id))
+            entries.append(Ledger_Entries.entry(payment.receiver_id, amount, EntryKind.receipt, payment.id, transaction_id))
+
+    if settled:
+        if entries:
+            Ledger_Entries.append(entries)
+
+        Payment.query.filter(Payment.id.in_(settled)) \
+            .update({Payment.state: PaymentState.completed, Payment.completed_at: datetime.datetime.utcnow()},
+                    synchronize_session=False)
+        Transaction.query.filter(Transaction.id_payment.in_(settled), Transaction.state == TransactionState.authorized) \
+            .update({Transaction.state: TransactionState.completed, Transaction.update_date: datetime.datetime.now()},
+                    synchronize_session=False)
+    db.session.commit()
+
+    return {
+        'after': (payments[-1].created_at, payments[-1].id),
+        'settled': len(settled),
+        'transactions': len(entries) // 2
+    }
+
+
+def settle_payments(cutoff, chunk_size):
+    """
+        Settles chunks until no authorized payment created up to cutoff is left after the last one claimed
+        :return: the counts of the payments settled and of the transactions paid
+    """
+    totals = {'settled': 0, 'transactions': 0}
+    after = None
+
+    while True:
+        chunk = settle_chunk(cutoff, after, chunk_size)
+        if chunk is None:
+            break
+
+        after = chunk['after']
+        for name in totals:
+            totals[name] += chunk[name]
+
+    db.session.remove()
+    return totals
+
+
+def settle_process(cutoff, chunk_size, results):
+    with app.app_context():
+        try:
+            results.put(settle_payments(cutoff, chunk_size))
+        except Exception:
+            # the chunks committed before the failure are kept, the parent must not wait forever
+            app.logger.exception('Settlement process failed')
+            results.put(None)
+
+
+def settle(processes=None, chunk_size=None):
+    """
+        Executes the payments authorized up to now in processes forked processes, each one with its
+        own connection. They all walk the payments in the same order and skip the ones claimed by another.
+        :return: the counts and the throughput of the run
+    """
+    processes = processes or app.config['SETTLEMENT_PROCESSES']
+    chunk_size = chunk_size or app.config['SETTLEMENT_CHUNK']
+    cutoff = datetime.datetime.utcnow()
+
+    # no connection of this process may be shared with the children
+    db.session.remove()
+    db.engine.dispose()
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [context.Process(target=settle_process, args=(cutoff, chunk_size, results)) for _ in range(processes)]
+
+    start = time.perf_counter()
+    deadline = time.monotonic() + app.config['SETTLEMENT_TIMEOUT']
+    for worker in workers:
+        worker.start()
+
+    counts = []
+    try:
+        for _ in workers:
+            counts.append(results.get(timeout=max(deadline - time.monotonic(), 0)))
+    except queue.Empty:
+        # killing a hung process drops its connection, postgres rolls back its chunk and the
+        # payments it claimed are authorized and unlocked again for the next run
+        for worker in workers:
+            if worker.is_alive():
+                app.logger.error('Settlement process %d did not finish in %d s, terminated',
+                                 worker.pid, app.config['SETTLEMENT_TIMEOUT'])
+                worker.terminate()
+        counts += [None] * (len(workers) - len(counts))
+
+    for worker in workers:
+        worker.join()
+    seconds = time.perf_counter() - start
+
+    finished = [count for count in counts if count is not None]
+    report = {name: sum(count[name] for count in finished) for name in ('settled', 'transactions')}
+    report['failed'] = len(counts) - len(finished)
+
+    # what the buyers could not pay, or a failed process left
+    report['rejected'] = Payment.query \
+        .filter(Payment.state == PaymentState.authorized, Payment.created_at <= cutoff) \
+        .count()
+    db.session.remove()
+
+    report['processes'] = processes
+    report['seconds'] = round(seconds, 3)
+    report['payments_per_second'] = round(report['settled'] / seconds, 1) if seconds else 0.0
+    app.logger.info('Settlement %s', report)
+    return report
+
+
+@app.cli.command('settle')
+@click.option('--processes', default=None, type=int, help='Processes settling in parallel')
+@click.option('--chunk-size', default=None, type=int, help='Payments settled per transaction')
+def settle_command(processes, chunk_size):
+    """Execute the authorized payments in bulk"""
+    report = settle(processes, chunk_size)
+    click.echo('Settled {settled} payments ({transactions} transactions) in {seconds} s with {processes} processes, '
+               '{payments_per_second} payments/s. {rejected} payments are still authorized, their buyers '
+               'do not have enough balance or they were being executed.'.format(**report))
+    if report['failed']:
+        click.echo('{} processes failed, see the log. Run it again to settle what they left.'.format(report['failed']))
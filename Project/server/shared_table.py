@@ -0,0 +1,202 @@
+# server/shared_table.py
+
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import tempfile
+import threading
+
+MAGIC = b'PSHT'
+VERSION = 2
+# magic, version, slots, and the number of slots holding a key
+HEADER = struct.Struct('<4sIIq')
+COUNT = struct.Struct('<q')
+COUNT_OFFSET = HEADER.size - COUNT.size
+SLOT = struct.Struct('<32sd')
+
+# expiration values with a special meaning
+EMPTY = 0.0
+DELETED = -1.0
+
+
+def shared_path(name):
+    """
+        Path of a file in shared memory (/dev/shm), or in the temporary directory where there is none
+    """
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+class SharedHashTable:
+    """
+        Fixed size hash table in a memory mapped file, shared by every process of a node.
+        Keys are hashed to a 32 bytes digest and mapped to an expiration timestamp.
+
+        Lookups do not take any lock: a slot digest is written before its expiration, so a
+        reader sees either an empty slot (a miss) or a complete one. Writers serialize with
+        a lock between the threads of a process and an exclusive flock on the file between
+        the processes. Collisions use linear probing, deleted slots are
+        kept as tombstones and reused, like the expired ones, by later inserts. The header
+        counts the slots holding a key, so the usage is read without scanning the table.
+    """
+
+    def __init__(self, path, slots, max_probe=32):
+        self.path = path
+        self.slots = slots
+        self.max_probe = min(max_probe, slots)
+        self.size = HEADER.size + slots * SLOT.size
+        self._pid = None
+        self._fd = None
+        self._map = None
+        # the threads of a process share the file description, and with it the flock
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        return hashlib.sha256(key).digest()
+
+    def get(self, key):
+        """
+            Returns the expiration of a live key, or None
+        """
+        buffer = self._map if self._pid == os.getpid() else self._open()
+        digest = self.digest(key)
+        index = int.from_bytes(digest[:8], 'little') % self.slots
+
+        for _ in range(self.max_probe):
+            slot_digest, expires_at = SLOT.unpack_from(buffer, HEADER.size + index * SLOT.size)
+            if expires_at == EMPTY:
+                return None
+            if slot_digest == digest and expires_at != DELETED:
+                return expires_at if expires_at > time.time() else None
+            index = (index + 1) % self.slots
+        return None
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def set(self, key, expires_at):
+        """
+            Inserts or refreshes a key. Returns False when its probe sequence is full
+        """
+        buffer = self._open()
+        digest = self.digest(key)
+        now = time.time()
+
+        with self._locked():
+            free = None
+            for offset in self._probe(digest):
+                slot_digest, slot_expires = SLOT.unpack_from(buffer, offset)
+                if slot_digest == digest and slot_expires != EMPTY:
+                    if slot_expires == DELETED:
+                        self._count(buffer, 1)
+                    struct.pack_into('<d', buffer, offset + 32, expires_at)
+                    return True
+                if free is None and (slot_expires == DELETED or slot_expires <= now):
+                    free = offset
+                if slot_expires == EMPTY:
+                    break
+
+            if free is None:
+                return False
+
+            # an expired slot was already counted, an empty or deleted one was not
+            _, free_expires = SLOT.unpack_from(buffer, free)
+            if free_expires == EMPTY or free_expires == DELETED:
+                self._count(buffer, 1)
+            struct.pack_into('<32s', buffer, free, digest)
+            struct.pack_into('<d', buffer, free + 32, expires_at)
+            return True
+
+    def delete(self, key):
+        buffer = self._open()
+        digest = self.digest(key)
+
+        with self._locked():
+            for offset in self._probe(digest):
+                slot_digest, slot_expires = SLOT.unpack_from(buffer, offset)
+                if slot_expires == EMPTY:
+                    return False
+                if slot_digest == digest and slot_expires != DELETED:
+                    struct.pack_into('<d', buffer, offset + 32, DELETED)
+                    self._count(buffer, -1)
+                    return True
+        return False
+
+    def usage(self):
+        """
+            The slots holding a key, the expired ones included until an insert reuses them
+        """
+        buffer = self._open()
+        occupied, = COUNT.unpack_from(buffer, COUNT_OFFSET)
+        return {'slots': self.slots, 'occupied': occupied}
+
+    @staticmethod
+    def _count(buffer, change):
+        # called with the file lock held
+        occupied, = COUNT.unpack_from(buffer, COUNT_OFFSET)
+        COUNT.pack_into(buffer, COUNT_OFFSET, occupied + change)
+
+    def _probe(self, digest):
+        start = int.from_bytes(digest[:8], 'little') % self.slots
+        for step in range(self.max_probe):
+            yield HEADER.size + ((start + step) % self.slots) * SLOT.size
+
+    def _open(self):
+        # every process maps the file itself, a flock is not exclusive between a parent and its fork
+        if self._pid == os.getpid():
+            return self._map
+
+        with self._lock:
+            # another thread of this process may have mapped it meanwhile
+            if self._pid == os.getpid():
+                return self._map
+            return self._map_file()
+
+    def _map_file(self):
+        if self._fd is not None:
+            os.close(self._fd)
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(fd, HEADER.size, 0)
+            if len(header) < HEADER.size or HEADER.unpack(header)[:3] != (MAGIC, VERSION, self.slots):
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, HEADER.pack(MAGIC, VERSION, self.slots, 0), 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        self._fd = fd
+        self._map = mmap.mmap(fd, self.size)
+        self._pid = os.getpid()
+        return self._map
+
+    def _locked(self):
+        return _FileLock(self._lock, self._fd)
+
+
+class _FileLock:
+    def __init__(self, lock, fd):
+        self.lock = lock
+        self.fd = fd
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *args):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            self.lock.release()
@@ -1,6 +1,10 @@
-from flask import request, Blueprint, session
+from flask import request, Blueprint, session, g
 from server import db
-from server.models import Account, Active_Sessions
+from server.routing import recent_writes
+from server.hashing import HashingBusy
+from server.pool import PoolTimeout
+from server.models import Account, Active_Sessions, token_cache, session_store
+from server.session_store import token_digest
 from server.auxiliar_functions import Message
 from functools import wraps
 from http import HTTPStatus
@@ -23,21 +27,48 @@ def login_required(f):
         if auth_token:
             try:
                 # For this project we will ignore the correct implementation of security
-                user_id = Account.decode_auth_token(auth_token.encode())
+                # The handler receives the account itself, loaded with the session check
+                account = Account.authenticate(auth_token.encode())
                 # data = request.headers['Authorization'].encode('ascii', 'ignore')
                 # token = str.replace(str(data), 'Bearer ', '')
                 # token = Account.encode_auth_token(token)
-                if user_id == 'Token invalid.':
-                    abort(401, "Token invalid")
+            except PoolTimeout:
+                # answered with 503 by the application error handler
+                raise
             except:
                 abort(401, "Something is wrong in the authentication")
-            return f(user_id, *args, **kws)
+            if account is None:
+                abort(401, "Token invalid")
+
+            g.account_id = account.id
+            response = f(account, *args, **kws)
+
+            # the next reads of the account stay on the primary until the replica has this change
+            if not getattr(f, 'read_only', False):
+                recent_writes.mark(account.id)
+            return response
         else:
             abort(401)
 
     return decorated_function
 
 
+def start_session(account):
+    """
+        Issues a new access token and refresh token for the account, and commits them.
+        Only the digests of the tokens are stored. Every login starts a new session, the
+        other sessions of the account stay valid.
+
+        :return: (auth_token, refresh_token)
+    """
+    auth_token = Account.encode_auth_token(account.id)
+    refresh_token = Active_Sessions.generate_refresh_token()
+    session_store.add(token_digest(auth_token), token_digest(refresh_token), account.user_id)
+    db.session.commit()
+
+    return auth_token.decode(), refresh_token
+
+
 # CONFIG
 user_controller = Blueprint('user', __name__)
 
@@ -50,49 +81,30 @@ def login():
     code = HTTPStatus.OK
     msg = Message()
 
-    user = Account.query.filter_by(user_id=request.json.get('user_id')).first()
-    print(user)
+    user = Account.find_by_id(request.json.get('user_id'))
+
     if user:
         try:
             # Get parameters
-            user_id = request.get_json()['user_id']
             password = request.get_json()['password']
-            
-            # fetch the user data
-            current_user = Account.find_by_id(user_id=user_id)
 
-            if not current_user:
-                code = HTTPStatus.NOT_FOUND
+            if Account.check_password_hash(user.password, password):
+
+                # Keep the stored hash at the cost tuned for this deployment
+                if user.needs_rehash():
+                    user.set_password(password)
+
+                # The new session and the rehashed password are written in the same commit
+                auth_token, refresh_token = start_session(user)
+                recent_writes.mark(user.id)
+
                 response = {
-                    'status': 'fail',
-                    'message': 'User {} doesn\'t exist'.format(user_id)
+                    'status': 'success',
+                    'message': 'Successfully logged in.',
+                    'auth_token': auth_token,
+                    'refresh_token': refresh_token
                 }
 
-            if Account.check_password_hash(current_user.password, password):
-
-                with_token = Active_Sessions.query.filter_by(user_id=user_id).first()
-                if with_token is None:
-                    auth_token = Account.encode_auth_token(current_user.id)
-                    # mark the token into Active_Sessions
-                    active_session = Active_Sessions(token=auth_token, user_id=user_id)
-                    active_session.save_to_db()
-
-                    if auth_token:
-                        response = {
-                            'status': 'success',
-                            'message': 'Successfully logged in.',
-                            'auth_token': auth_token.decode()
-                        }
-                else:
-                    auth_token = with_token.token
-
-                    if auth_token:
-                        response = {
-                            'status': 'success',
-                            'message': 'Successfully logged in.',
-                            'auth_token': auth_token.replace("b\'", "").replace("\'", "")
-                        }
-
             else:
                 code = HTTPStatus.BAD_REQUEST
                 response = {
@@ -100,6 +112,9 @@ def login():
                     'message': 'Wrong Credentials'
                 }
 
+        except (HashingBusy, PoolTimeout):
+            # answered with 503 by the application error handlers
+            raise
         except Exception as e:
             code = HTTPStatus.INTERNAL_SERVER_ERROR
             response = {
@@ -115,45 +130,98 @@ def login():
     return msg.message(code, response)
 
 
-@user_controller.route('/user/logout', methods=['POST'])
-@login_required
-def logout(account_id):
+@user_controller.route('/user/refresh', methods=['POST'])
+def refresh():
     """
-        Logout Resource
+        Exchanges a refresh token for a new access token and refresh token, without the password
     """
-    # get auth token
     code = HTTPStatus.OK
     msg = Message()
 
-    account = Account.query.filter_by(id=account_id).first()
+    refresh_token = request.json.get('refresh_token')
 
-    if account:
-        if account.state:
-            active = Active_Sessions.query.filter_by(user_id=account.user_id).first()
+    try:
+        next_refresh_token = Active_Sessions.generate_refresh_token()
+        # of two refreshes with the same token only the first one swaps it
+        rotated = Active_Sessions.rotate(token_digest(refresh_token), token_digest(next_refresh_token)) \
+            if refresh_token else None
 
-            if active:
-                Active_Sessions.query.filter(Active_Sessions.user_id == account.user_id).delete()            
-                response = {
-                    'status': 'success',
-                    'message': 'Successfully logged out.'
-                }
+        if rotated:
+            session_id, user_id, previous_hash = rotated
+            account = Account.find_by_id(user_id)
+            auth_token = Account.encode_auth_token(account.id)
+            token_hash = token_digest(auth_token)
+            Active_Sessions.set_token(session_id, token_hash)
+            db.session.commit()
+            recent_writes.mark(account.id)
+
+            session_store.remember(token_hash)
+            session_store.discard(previous_hash)
+
+            response = {
+                'status': 'success',
+                'message': 'Successfully refreshed.',
+                'auth_token': auth_token.decode(),
+                'refresh_token': next_refresh_token
+            }
         else:
             code = HTTPStatus.UNAUTHORIZED
             response = {
                 'status': 'fail',
-                'message': 'Yout account is desactivated'
+                'message': 'Invalid refresh token. Please log in again.'
             }
-        return msg.message(code, response)
+    except Exception as e:
+        code = HTTPStatus.INTERNAL_SERVER_ERROR
+        response = {
+            'status': 'fail',
+            'message': str(e)
+        }
+    return msg.message(code, response)
+
+
+@user_controller.route('/user/logout', methods=['POST'])
+@login_required
+def logout(account):
+    """
+        Logout Resource
+    """
+    # get auth token
+    code = HTTPStatus.OK
+    msg = Message()
+
+    if account.state:
+        # only the session of this token ends, the other logins of the account stay valid
+        auth_token = request.headers.get('Authorization')
+        token_hash = token_digest(auth_token)
+
+        session_store.remove(token_hash)
+        db.session.commit()
+        session_store.discard(token_hash)
+        token_cache.pop(auth_token.encode())
+        response = {
+            'status': 'success',
+            'message': 'Successfully logged out.'
+        }
     else:
-        code = HTTPStatus.FORBIDDEN
+        code = HTTPStatus.UNAUTHORIZED
         response = {
             'status': 'fail',
-            'message': 'Provide a valid auth token.'
+            'message': 'Yout account is desactivated'
         }
-        return msg.message(code, response)
+    return msg.message(code, response)
 
 
-@user_controller.route('/user/check/<uuid:token>', methods=['POST'])
+@user_controller.route('/user/check/<token>', methods=['POST'])
 @login_required
-def check_token(self, account_id, token):
-    return True if Active_Sessions.query.filter_by(token=token, user_id=account_id) else False
\ No newline at end of file
+def check_token(account, token):
+    """
+        Tells if a token is an active session of the authenticated account
+    """
+    msg = Message()
+    active = Active_Sessions.query.filter_by(token_hash=token_digest(token), user_id=account.user_id).first()
+
+    response = {
+        'status': 'success',
+        'active': active is not None
+    }
+    return msg.message(HTTPStatus.OK, response)
\ No newline at end of file
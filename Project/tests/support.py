@@ -0,0 +1,52 @@
+# Project/tests/support.py
+#
+# Setup shared by the tests and the benchmarks that build the app in process. They need the
+# postgres of docker-compose running and migrated (flask migrate). Import this module before
+# server: the bcrypt settings are read when the app is created.
+
+import os
+import uuid
+import json
+import unittest
+
+# a login costs a few milliseconds instead of a calibrated bcrypt, and no process pool is started
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+os.environ.setdefault('BCRYPT_POOL_SIZE', '0')
+
+from iso4217 import Currency
+from server import app
+from server.models import Account
+
+PASSWORD = 'my-precious'
+
+
+def new_account():
+    """
+        Saves an account in EUR with a random user id and PASSWORD
+    """
+    account = Account(user_id=str(uuid.uuid4()), password=PASSWORD, currency=Currency('EUR'))
+    account.save_to_db()
+    return account
+
+
+class AppTestCase(unittest.TestCase):
+    """
+        Calls the endpoints through the test client of the app, with the auth token of self.token if set
+    """
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def post(self, path, data=None, token=None, headers=None):
+        headers = dict(headers or {})
+        token = token or getattr(self, 'token', None)
+        if token:
+            headers['Authorization'] = token
+        return self.client.post(path, data=json.dumps(data), headers=headers, content_type='application/json')
+
+    def login(self, account):
+        """
+            The auth and refresh tokens of a new session of the account
+        """
+        data = {'user_id': account.user_id, 'password': PASSWORD}
+        return self.post('/user/login', data).get_json()['message']
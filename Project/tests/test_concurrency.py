@@ -0,0 +1,108 @@
+# Project/tests/test_concurrency.py
+#
+# Fires parallel requests at a running service. The accounts are saved directly in its database,
+# so the test runs with the same DATABASE_URL as the service.
+
+import os
+import json
+import unittest
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from tests.support import PASSWORD, new_account
+
+URL = os.getenv('PAYMENT_SERVICE_URL', 'http://0.0.0.0:5000')
+PARALLEL = 20
+
+
+def login_user(user_id, password):
+    headers = {'Content-Type': "application/json"}
+    data = json.dumps({'user_id': str(user_id), 'password': password})
+    response = requests.post(URL + '/user/login', headers=headers, data=data)
+    return {'Content-Type': "application/json", 'Authorization': response.json()['message']['auth_token']}
+
+
+def logged_in_account():
+    account = new_account()
+    return str(account.id), login_user(account.user_id, PASSWORD)
+
+
+def balance(headers):
+    return requests.get(URL + '/account/', headers=headers).json()['message']['account']['balance']
+
+
+def deposit(headers, amount):
+    return requests.post(URL + '/account/amount', headers=headers, data=json.dumps({'amount': amount}))
+
+
+def authorized_payment(headers, seller, amount):
+    data = json.dumps({'request_id': 'bilhete', 'seller_id': seller, 'currency': 'EUR', 'reference': 'Porto - Lisboa'})
+    payment = requests.post(URL + '/payments/', headers=headers, data=data).json()['message']['id']
+
+    data = json.dumps({'amount': amount, 'reference': 'Porto - Lisboa'})
+    requests.post(URL + '/payments/' + payment + '/transactions', headers=headers, data=data)
+    requests.post(URL + '/payments/' + payment + '/authorize', headers=headers)
+    requests.post(URL + '/payments/' + payment + '/authorize/response')
+    return payment
+
+
+def execute(headers, payment):
+    return requests.post(URL + '/payments/' + payment + '/execute', headers=headers).json()
+
+
+class TestConcurrency(unittest.TestCase):
+
+    def test_parallel_deposits(self):
+        """ Test that no parallel deposit is lost """
+
+        print(" --------------------------- Test 1 - Parallel deposits ----------------------------")
+
+        _, headers = logged_in_account()
+
+        with ThreadPoolExecutor(PARALLEL) as pool:
+            list(pool.map(lambda _: deposit(headers, 10.0), range(PARALLEL * 5)))
+
+        self.assertEqual(balance(headers), PARALLEL * 5 * 10.0)
+
+    def test_parallel_executes(self):
+        """ Test that parallel executes neither lose nor create money, nor overdraw the buyer """
+
+        print(" --------------------------- Test 2 - Parallel executes ----------------------------")
+
+        _, buyer = logged_in_account()
+        seller, seller_headers = logged_in_account()
+
+        # Enough money for half of the payments
+        deposit(buyer, PARALLEL * 10.0 / 2)
+        payments = [authorized_payment(buyer, seller, 10.0) for _ in range(PARALLEL)]
+
+        with ThreadPoolExecutor(PARALLEL) as pool:
+            results = list(pool.map(lambda payment: execute(buyer, payment), payments))
+
+        executed = [r for r in results if r['message']['status'] == 'success']
+        self.assertEqual(len(executed), PARALLEL // 2)
+        self.assertEqual(balance(buyer), 0.0)
+        self.assertEqual(balance(seller_headers), PARALLEL * 10.0 / 2)
+
+    def test_parallel_deposits_and_executes(self):
+        """ Test that money is kept while deposits and executes run together """
+
+        print(" --------------------------- Test 3 - Parallel deposits and executes ----------------------------")
+
+        _, buyer = logged_in_account()
+        seller, seller_headers = logged_in_account()
+
+        deposit(buyer, PARALLEL * 10.0)
+        payments = [authorized_payment(buyer, seller, 10.0) for _ in range(PARALLEL)]
+
+        with ThreadPoolExecutor(PARALLEL) as pool:
+            work = [pool.submit(execute, buyer, payment) for payment in payments]
+            work += [pool.submit(deposit, buyer, 1.0) for _ in range(PARALLEL)]
+            for future in work:
+                future.result()
+
+        self.assertEqual(balance(buyer), PARALLEL * 1.0)
+        self.assertEqual(balance(seller_headers), PARALLEL * 10.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# Project/tests/test_idempotency.py
+#
+# Retries POST /payments/ with the same Idempotency-Key through the test client of the app.
+
+import uuid
+import unittest
+from tests.support import AppTestCase, new_account
+from server.models import Idempotency_Keys, Payment
+
+
+class TestIdempotency(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        buyer = new_account()
+        self.buyer = buyer.id
+        self.seller = str(new_account().id)
+        self.token = self.login(buyer)['auth_token']
+
+    def payment(self, reference, key):
+        data = {'request_id': 'bilhete', 'seller_id': self.seller, 'currency': 'EUR', 'reference': reference}
+        return self.post('/payments/', data, headers=self.idempotency_key(key))
+
+    @staticmethod
+    def idempotency_key(key):
+        return {'Idempotency-Key': key} if key is not None else {}
+
+    def test_retry_is_replayed(self):
+        """ Test that a retry with the same key returns the first response and creates nothing """
+        key = str(uuid.uuid4())
+        first = self.payment('Porto - Lisboa', key)
+        retry = self.payment('Porto - Lisboa', key)
+
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(retry.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEqual(Payment.query.filter_by(account_id=self.buyer).count(), 1)
+
+    def test_key_reused_for_another_request(self):
+        """ Test that a key sent again with another body is refused """
+        key = str(uuid.uuid4())
+        self.payment('Porto - Lisboa', key)
+        other = self.payment('Lisboa - Faro', key)
+
+        self.assertEqual(other.get_json()['code'], 422)
+        self.assertEqual(Payment.query.filter_by(account_id=self.buyer).count(), 1)
+
+    def test_failed_create_is_not_replayed(self):
+        """ Test that a create that failed with a 500 keeps no response, so its retry runs again """
+        payment = self.payment('Porto - Lisboa', None).get_json()['message']['id']
+        path = '/payments/{}/transactions'.format(payment)
+        key = str(uuid.uuid4())
+
+        # a null body makes the handler fail
+        first = self.post(path, None, headers=self.idempotency_key(key))
+        retry = self.post(path, None, headers=self.idempotency_key(key))
+
+        self.assertEqual(first.get_json()['code'], 500)
+        self.assertEqual(retry.get_json()['code'], 500)
+        self.assertIsNone(retry.headers.get('Idempotent-Replayed'))
+        self.assertIsNone(Idempotency_Keys.find(self.buyer, key))
+
+    def test_without_key(self):
+        """ Test that requests without the header are all run """
+        self.payment('Porto - Lisboa', None)
+        self.payment('Porto - Lisboa', None)
+
+        self.assertEqual(Payment.query.filter_by(account_id=self.buyer).count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
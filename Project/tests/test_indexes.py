@@ -0,0 +1,139 @@
+# Project/tests/test_indexes.py
+#
+# Checks with EXPLAIN that the lookups of payments and transactions use their indexes.
+# transaction is partitioned, its scans use the partitions of the indexes.
+# It runs against the same migrated postgres as tests/support.py. The million
+# rows are inserted in a transaction that is rolled back at the end.
+
+import enum
+import uuid
+import json
+import datetime
+import unittest
+from sqlalchemy.dialects import postgresql
+from server import db
+from server.models import Payment, Transaction, TransactionState
+from server.pagination import keyset
+
+ACCOUNTS = 2000
+PAYMENTS = 200000
+TRANSACTIONS_PER_PAYMENT = 5
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+class TestIndexes(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.connection = db.engine.connect()
+        cls.transaction = cls.connection.begin()
+        # the inserts take longer than the DB_STATEMENT_TIMEOUT of the requests
+        cls.connection.execute('SET LOCAL statement_timeout = 0')
+
+        cls.connection.execute("""
+            INSERT INTO account (user_id, password, currency, state, created_at, updated_at)
+            SELECT 'explain-' || i, 'x', 'eur', true, now(), now()
+            FROM generate_series(1, %s) i
+        """, ACCOUNTS)
+        cls.connection.execute("""
+            INSERT INTO payment (request_id, account_id, receiver_id, created_at, state, amount, currency, reference)
+            SELECT 'explain', buyer.id, seller.id, now() - i * interval '1 second', 'authorized', 500, 'eur', 'explain'
+            FROM generate_series(1, %s) i
+            JOIN account buyer ON buyer.user_id = 'explain-' || (i %% %s + 1)
+            JOIN account seller ON seller.user_id = 'explain-' || ((i + 1) %% %s + 1)
+        """, PAYMENTS, ACCOUNTS, ACCOUNTS)
+        cls.connection.execute("""
+            INSERT INTO transaction (amount, emission_date, state, update_date, id_payment, reference)
+            SELECT 100, now(), 'authorized', now(), payment.id, 'explain'
+            FROM payment, generate_series(1, %s)
+            WHERE payment.request_id = 'explain'
+        """, TRANSACTIONS_PER_PAYMENT)
+        cls.connection.execute('ANALYZE account, payment, transaction')
+
+        cls.account_id, cls.payment_id = cls.connection.execute(
+            "SELECT account_id, id FROM payment WHERE request_id = 'explain' LIMIT 1").first()
+
+        # the tables that got the rows, the other partitions are empty and may be read sequentially
+        partition = cls.connection.execute(
+            "SELECT tableoid::regclass::text FROM transaction WHERE reference = 'explain' LIMIT 1").scalar()
+        cls.large = {'account', 'payment', partition}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.transaction.rollback()
+        cls.connection.close()
+
+    def explain(self, query):
+        """
+            The nodes of the plan postgres chooses for an ORM query
+        """
+        compiled = query.statement.compile(dialect=postgresql.psycopg2.dialect())
+        params = {
+            name: value.name if isinstance(value, enum.Enum) else str(value) if isinstance(value, uuid.UUID) else value
+            for name, value in compiled.params.items()
+        }
+        result = self.connection.execute('EXPLAIN (FORMAT JSON) ' + str(compiled), params).scalar()
+        plan = result if isinstance(result, list) else json.loads(result)
+        return list(plan_nodes(plan[0]['Plan']))
+
+    def assertUsesIndex(self, query, *accepted):
+        indexes = set(accepted)
+        for index in accepted:
+            indexes.update(name for name, in self.connection.execute("""
+                SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = to_regclass(%s)
+            """, index))
+
+        nodes = self.explain(query)
+        self.assertTrue(indexes & {node.get('Index Name') for node in nodes}, nodes)
+        self.assertFalse([node for node in nodes if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in self.large],
+                         nodes)
+        return nodes
+
+    def test_payments_of_buyer(self):
+        """ Test that get_payments finds the payments of a buyer by index """
+        self.assertUsesIndex(Payment.query.filter_by(account_id=self.account_id),
+                             'ix_payment_account_id_created_at_id')
+
+    def test_payments_of_seller(self):
+        """ Test that the payments of a seller are found by index """
+        self.assertUsesIndex(Payment.query.filter_by(receiver_id=self.account_id), 'ix_payment_receiver_id')
+
+    def test_transactions_of_payment(self):
+        """ Test that get_transactions and authorize find the transactions of a payment by index """
+        self.assertUsesIndex(Transaction.query.filter_by(id_payment=self.payment_id),
+                             'ix_transaction_id_payment_state', 'ix_transaction_id_payment_emission_date_id')
+
+    def test_transactions_of_payment_in_state(self):
+        """ Test that execute and authorize_response find the transactions in a state by index """
+        self.assertUsesIndex(
+            db.session.query(Transaction.id, Transaction.amount)
+            .filter(Transaction.id_payment == self.payment_id, Transaction.state == TransactionState.authorized),
+            'ix_transaction_id_payment_state')
+
+    def test_page_of_payments(self):
+        """ Test that a page of get_payments after a cursor is read in the order of the index, without sorting """
+        after = (datetime.datetime.utcnow() - datetime.timedelta(hours=1), uuid.uuid4())
+        query = keyset(Payment.query.filter_by(account_id=self.account_id),
+                       Payment.created_at, Payment.id, after, 50, descending=True)
+
+        nodes = self.assertUsesIndex(query, 'ix_payment_account_id_created_at_id')
+        self.assertNotIn('Sort', [node['Node Type'] for node in nodes], nodes)
+
+    def test_page_of_transactions(self):
+        """ Test that a page of get_transactions after a cursor is read in the order of the index, without sorting """
+        after = (datetime.datetime.utcnow() - datetime.timedelta(hours=1), uuid.uuid4())
+        query = keyset(Transaction.query.filter_by(id_payment=self.payment_id),
+                       Transaction.emission_date, Transaction.id, after, 50)
+
+        nodes = self.assertUsesIndex(query, 'ix_transaction_id_payment_emission_date_id')
+        self.assertNotIn('Sort', [node['Node Type'] for node in nodes], nodes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+# Project/tests/test_ledger.py
+#
+# Executes payments through the test client of the app and checks the ledger entries they append.
+
+import uuid
+import unittest
+from tests.support import AppTestCase, new_account
+from server.models import Ledger_Entries, Payment, PaymentState
+
+
+class TestLedger(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        buyer = new_account()
+        self.seller = new_account().id
+        self.token = self.login(buyer)['auth_token']
+
+    def test_execute_with_every_transaction_cancelled(self):
+        """ Test that a payment whose transactions were all cancelled is executed with no entries """
+        data = {'request_id': 'bilhete', 'seller_id': str(self.seller), 'currency': 'EUR', 'reference': 'Porto - Lisboa'}
+        payment = self.post('/payments/', data).get_json()['message']['id']
+        path = '/payments/{}'.format(payment)
+
+        transaction = self.post(path + '/transactions', {'amount': '10.00', 'reference': 'leg'}).get_json()['message']['id']
+        self.post('{}/transactions/{}/cancel'.format(path, transaction))
+        self.post(path + '/authorize')
+        self.post(path + '/authorize/response')
+
+        executed = self.post(path + '/execute').get_json()
+        self.assertEqual(executed['code'], 200)
+        self.assertEqual(Payment.query.get(uuid.UUID(payment)).state, PaymentState.completed)
+        self.assertEqual(Ledger_Entries.query.filter_by(payment_id=uuid.UUID(payment)).count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# Project/tests/test_maintenance.py
+#
+# Runs the maintenance jobs on a payment of January 2001. Their settings are chosen so that
+# they only reach rows older than February 2001, and leave the rest of the database alone.
+
+import datetime
+import unittest
+from tests.support import new_account
+from iso4217 import Currency
+from server import app, db
+from server.maintenance import archive_payments, manage_transaction_partitions
+from server.models import Payment, Payment_Archive, PaymentState, Transaction
+
+MONTH = datetime.datetime(2001, 1, 1)
+NEXT_MONTH = datetime.datetime(2001, 2, 1)
+PARTITION = 'transaction_2001_01'
+
+
+class TestMaintenance(unittest.TestCase):
+
+    def setUp(self):
+        self.config = {name: app.config[name] for name in ('TRANSACTION_RETENTION_MONTHS', 'PAYMENT_ARCHIVE_AGE_DAYS')}
+
+    def tearDown(self):
+        app.config.update(self.config)
+        db.session.rollback()
+        db.session.execute('DROP TABLE IF EXISTS {}'.format(PARTITION))
+        db.session.commit()
+
+    def test_archive_after_the_month_was_detached(self):
+        """ Test that a payment is archived after the partition of its transactions was detached """
+        db.session.execute(db.text('SELECT create_transaction_partition(:month)'), {'month': MONTH})
+
+        payment = Payment('bilhete', new_account().id, new_account().id, Currency('EUR'), 'Porto - Lisboa')
+        payment.created_at = MONTH + datetime.timedelta(days=14)
+        payment.state = PaymentState.completed
+        payment.amount = 1000
+        db.session.add(payment)
+        db.session.flush()
+
+        transaction = Transaction(1000, payment.id, 'leg')
+        transaction.emission_date = payment.created_at
+        db.session.add(transaction)
+        db.session.commit()
+        payment_id = payment.id
+
+        # the retention is shorter than the archive age: the month is detached first
+        today = datetime.date.today()
+        app.config['TRANSACTION_RETENTION_MONTHS'] = today.year * 12 + today.month - (NEXT_MONTH.year * 12 + 2)
+        app.config['PAYMENT_ARCHIVE_AGE_DAYS'] = (datetime.datetime.utcnow() - NEXT_MONTH).days
+
+        self.assertEqual(manage_transaction_partitions()['detached'], [PARTITION])
+        self.assertGreaterEqual(archive_payments(), 1)
+
+        self.assertIsNone(db.session.query(Payment.id).filter(Payment.id == payment_id).scalar())
+        self.assertIsNotNone(db.session.query(Payment_Archive.id).filter(Payment_Archive.id == payment_id).scalar())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# Project/tests/test_replica.py
+#
+# Checks which database the queries of an endpoint are sent to. It needs DATABASE_REPLICA_URL,
+# a second local postgres is enough since the test only compares the engines chosen.
+
+import uuid
+import unittest
+from flask import g
+from server import app, db
+from server.routing import read_only, recent_writes
+
+
+def bind():
+    return db.session.get_bind()
+
+
+@unittest.skipUnless(app.config['SQLALCHEMY_REPLICA_URI'], 'DATABASE_REPLICA_URL is not set')
+class TestReplica(unittest.TestCase):
+
+    def setUp(self):
+        self.primary = db.get_engine(app)
+        self.replica = db.get_engine(app, bind='replica')
+
+    def test_read_only_endpoint_uses_replica(self):
+        """ Test that a read-only endpoint reads from the replica """
+        with app.test_request_context():
+            g.account_id = uuid.uuid4()
+            self.assertIs(read_only(bind)(), self.replica)
+
+    def test_other_endpoints_use_primary(self):
+        """ Test that the other endpoints, and a read-only one after it returns, use the primary """
+        with app.test_request_context():
+            g.account_id = uuid.uuid4()
+            self.assertIs(bind(), self.primary)
+            read_only(bind)()
+            self.assertIs(bind(), self.primary)
+
+    def test_reads_own_writes(self):
+        """ Test that an account that just wrote reads from the primary """
+        account_id = uuid.uuid4()
+        recent_writes.mark(account_id)
+
+        with app.test_request_context():
+            g.account_id = account_id
+            self.assertIs(read_only(bind)(), self.primary)
+
+            g.account_id = uuid.uuid4()
+            self.assertIs(read_only(bind)(), self.replica)
+
+
+if __name__ == '__main__':
+    unittest.main()
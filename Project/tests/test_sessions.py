@@ -0,0 +1,58 @@
+# Project/tests/test_sessions.py
+#
+# Logs in, refreshes and logs out through the test client of the app.
+
+import unittest
+from tests.support import AppTestCase, new_account
+from server import db
+from server.session_store import token_digest
+from server.models import Active_Sessions, session_store
+
+
+class TestSessions(AppTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.account = new_account()
+
+    def authorized(self, token):
+        return self.client.get('/account/', headers={'Authorization': token}).status_code == 200
+
+    def test_logins_on_two_devices(self):
+        """ Test that a second login keeps the first one, and a logout ends only its own session """
+        phone = self.login(self.account)['auth_token']
+        laptop = self.login(self.account)['auth_token']
+        self.assertTrue(self.authorized(phone))
+        self.assertTrue(self.authorized(laptop))
+
+        self.post('/user/logout', token=phone)
+        self.assertFalse(self.authorized(phone))
+        self.assertTrue(self.authorized(laptop))
+
+    def test_refresh_token_works_once(self):
+        """ Test that of two refreshes with the same token only the first one gets new tokens """
+        session = self.login(self.account)
+        first = self.post('/user/refresh', {'refresh_token': session['refresh_token']}).get_json()
+        second = self.post('/user/refresh', {'refresh_token': session['refresh_token']}).get_json()
+
+        self.assertEqual(first['code'], 200)
+        self.assertEqual(second['code'], 401)
+        self.assertFalse(self.authorized(session['auth_token']))
+        self.assertTrue(self.authorized(first['message']['auth_token']))
+
+    def test_logout_on_another_worker(self):
+        """ Test that a token cached by this worker is rejected once another worker logs it out """
+        token = self.login(self.account)['auth_token']
+        self.assertTrue(self.authorized(token))
+
+        # what a logout does on another worker, which leaves the token cache of this one as it is
+        token_hash = token_digest(token)
+        Active_Sessions.query.filter_by(token_hash=token_hash).delete()
+        db.session.commit()
+        session_store.discard(token_hash)
+
+        self.assertFalse(self.authorized(token))
+
+
+if __name__ == '__main__':
+    unittest.main()
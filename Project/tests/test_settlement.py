@@ -0,0 +1,59 @@
+# Project/tests/test_settlement.py
+#
+# Settles authorized payments in one process and checks the balances and the states left.
+
+import datetime
+import unittest
+from tests.support import new_account
+from iso4217 import Currency
+from server import db
+from server.models import Account, Ledger_Entries, Payment, PaymentState, Transaction, TransactionState
+from server.settlement import settle_payments
+
+
+def authorized_payment(buyer, seller, created_at, amounts):
+    payment = Payment('bilhete', buyer, seller, Currency('EUR'), 'Porto - Lisboa')
+    payment.created_at = created_at
+    payment.state = PaymentState.authorized
+    payment.amount = sum(amounts)
+    db.session.add(payment)
+    db.session.flush()
+
+    Transaction.create_many(payment.id, [(amount, 'leg') for amount in amounts])
+    Transaction.transition(payment.id, TransactionState.created, TransactionState.authorized)
+    db.session.commit()
+    return payment.id
+
+
+class TestSettlement(unittest.TestCase):
+
+    def test_settles_while_balance_allows(self):
+        """ Test that the oldest payments are paid while the buyer has money, and the others stay authorized """
+        buyer = new_account().id
+        seller = new_account().id
+        Account.deposit(buyer, 1500)
+        db.session.commit()
+
+        start = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        payments = [
+            authorized_payment(buyer, seller, start, [600, 400]),
+            authorized_payment(buyer, seller, start + datetime.timedelta(seconds=1), [500]),
+            authorized_payment(buyer, seller, start + datetime.timedelta(seconds=2), [200])
+        ]
+
+        # chunks of two, so the buyer is settled across two database transactions
+        settle_payments(datetime.datetime.utcnow(), 2)
+
+        self.assertEqual(Ledger_Entries.balances([buyer, seller]), {buyer: 0, seller: 1500})
+        states = dict(db.session.query(Payment.id, Payment.state).filter(Payment.id.in_(payments)))
+        self.assertEqual([states[payment] for payment in payments],
+                         [PaymentState.completed, PaymentState.completed, PaymentState.authorized])
+
+        completed = Transaction.query \
+            .filter(Transaction.id_payment.in_(payments), Transaction.state == TransactionState.completed) \
+            .count()
+        self.assertEqual(completed, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()